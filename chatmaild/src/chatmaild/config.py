@@ -82,9 +82,43 @@ class Config:
         self.min_free_disk_space_mb = parse_size_mb(
             params.pop("min_free_disk_space", "1G")
         )
+        self.resource_sample_interval = float(params.pop("resource_sample_interval", 5))
         self.max_imap_connections = int(params.pop("max_imap_connections", 10000))
         self.max_smtp_connections = int(params.pop("max_smtp_connections", 1000))
 
+        self.dictproxy_engine = params.pop("dictproxy_engine", "threads").strip()
+        if self.dictproxy_engine not in ("threads", "asyncio"):
+            raise ValueError(
+                f"dictproxy_engine must be 'threads' or 'asyncio',"
+                f" got {self.dictproxy_engine!r}"
+            )
+        self.dictproxy_workers = int(params.pop("dictproxy_workers", 16))
+        self.doveauth_workers = int(params.pop("doveauth_workers", 1))
+        if self.doveauth_workers < 1:
+            raise ValueError(
+                f"doveauth_workers must be at least 1, got {self.doveauth_workers}"
+            )
+        self.metadata_backend = params.pop("metadata_backend", "maildir").strip()
+        if self.metadata_backend not in ("maildir", "sqlite"):
+            raise ValueError(
+                f"metadata_backend must be 'maildir' or 'sqlite',"
+                f" got {self.metadata_backend!r}"
+            )
+        self.notification_http2_streams = int(
+            params.pop("notification_http2_streams", 0)
+        )
+        self.mailbox_scan_workers = int(params.pop("mailbox_scan_workers", 4))
+        self.expire_filename_only = (
+            params.pop("expire_filename_only", "false").lower() == "true"
+        )
+        self.userdb_cache_size = int(params.pop("userdb_cache_size", 10000))
+        self.password_cache_ttl = int(params.pop("password_cache_ttl", 0))
+        self.userdb_iterate_snapshot = (
+            params.pop("userdb_iterate_snapshot", "false").lower() == "true"
+        )
+        self.password_hash_workers = int(params.pop("password_hash_workers", 0))
+        self.password_hash_queue_size = int(params.pop("password_hash_queue_size", 100))
+
         # TLS certificate management.
         # If tls_external_cert_and_key is set, use externally managed certs.
         # Otherwise derived from the domain name:
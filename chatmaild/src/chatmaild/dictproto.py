@@ -0,0 +1,78 @@
+"""
+Parsing and encoding of Dovecot dict protocol lines.
+
+see https://doc.dovecot.org/2.3/developer_manual/design/dict_protocol/#dovecot-dict-protocol
+
+Requests are single lines starting with a command character
+followed by tab-separated arguments.
+Replies are single lines starting with a result character;
+iterations reply with one line per result and finish with an empty line.
+"""
+
+import re
+
+REPLY_OK = "O\n"
+REPLY_NOT_FOUND = "N\n"
+REPLY_FAILED = "F\n"
+REPLY_ITER_FINISHED = "\n"
+
+_escape_rex = re.compile(r'\\(.)|"', re.DOTALL)
+
+
+def parse_request(line):
+    """Return the command character and the arguments of a request line.
+
+    ``line`` may be bytes as read from the socket or an already decoded string.
+    An empty command character is returned for empty lines.
+    """
+    if isinstance(line, bytes):
+        line = line.decode()
+    line = line.strip()
+    if not line:
+        return "", []
+    return line[0], line[1:].split("\t")
+
+
+def format_request(command, parts):
+    """Return the request line for a parsed request, e.g. for logging."""
+    return command + "\t".join(parts)
+
+
+def split_and_unescape(s):
+    """Split strings using double quote as a separator and backslash as escape character
+    into parts.
+
+    Runs in linear time; raises ValueError if ``s`` ends in an escape character.
+    """
+    if "\\" not in s:
+        return s.split('"')
+
+    parts = []
+    out = []
+    pos = 0
+    for m in _escape_rex.finditer(s):
+        out.append(s[pos : m.start()])
+        escaped = m.group(1)
+        if escaped is None:
+            parts.append("".join(out))
+            out = []
+        else:
+            out.append(escaped)
+        pos = m.end()
+
+    rest = s[pos:]
+    if "\\" in rest:
+        raise ValueError(f"dangling escape character in {s!r}")
+    out.append(rest)
+    parts.append("".join(out))
+    return parts
+
+
+def reply_ok(value):
+    """Return a successful lookup reply carrying a single-line value."""
+    return "O" + value + "\n"
+
+
+def reply_iter_item(key, value=""):
+    """Return one result line of an iteration."""
+    return "O" + key + "\t" + value + "\n"
@@ -1,7 +1,60 @@
+import asyncio
 import logging
 import os
+import signal
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
 from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
 
+from .dictproto import (
+    REPLY_FAILED,
+    REPLY_ITER_FINISHED,
+    REPLY_NOT_FOUND,
+    REPLY_OK,
+    format_request,
+    parse_request,
+)
+
+# maximum number of bytes taken from a connection's receive buffer at once
+READ_SIZE = 65536
+
+# seconds to wait before restarting an exited prefork worker
+WORKER_RESTART_DELAY = 1
+
+# first file descriptor passed by systemd socket activation
+SD_LISTEN_FDS_START = 3
+
+
+def split_lines(pending, data):
+    """Return complete lines from ``pending + data`` and the remaining partial line.
+
+    Empty ``data`` signals end of input, so the partial line is returned as well.
+    """
+    if not data:
+        return [pending], b""
+    *lines, pending = (pending + data).split(b"\n")
+    return lines, pending
+
+
+def iter_reply_data(replies):
+    """Yield encoded data for a batch of replies.
+
+    Replies are strings, or iterators of strings for replies that are
+    streamed in chunks. Consecutive strings are joined into one write.
+    """
+    pending = []
+    for reply in replies:
+        if isinstance(reply, str):
+            pending.append(reply)
+            continue
+        for chunk in reply:
+            pending.append(chunk)
+            yield "".join(pending).encode("ascii")
+            pending = []
+    if pending:
+        yield "".join(pending).encode("ascii")
+
 
 class DictProxy:
     def loop_forever(self, rfile, wfile):
@@ -10,22 +63,40 @@ class DictProxy:
         # starting transaction with the name `1`
         # on two different connections to the same proxy sometimes.
         transactions = {}
+        pending = b""
 
         while True:
-            msg = rfile.readline().strip().decode()
-            if not msg:
+            # Dovecot pipelines requests, so we handle all complete lines
+            # received so far and write their replies with a single flush.
+            data = rfile.read1(READ_SIZE)
+            lines, pending = split_lines(pending, data)
+            replies, finished = self.handle_lines(lines, transactions)
+            for data in iter_reply_data(replies):
+                wfile.write(data)
+                wfile.flush()
+            if finished:
                 break
 
-            res = self.handle_dovecot_request(msg, transactions)
+    def handle_lines(self, lines, transactions):
+        """Handle request lines in order and return their replies
+        and whether the connection is finished."""
+        replies = []
+        for line in lines:
+            command, parts = parse_request(line)
+            if not command:
+                return replies, True
+
+            res = self.handle_request(command, parts, transactions)
             if res:
-                wfile.write(res.encode("ascii"))
-                wfile.flush()
+                replies.append(res)
+        return replies, False
 
     def handle_dovecot_request(self, msg, transactions):
-        # see https://doc.dovecot.org/2.3/developer_manual/design/dict_protocol/#dovecot-dict-protocol
-        short_command = msg[0]
-        parts = msg[1:].split("\t")
+        command, parts = parse_request(msg)
+        return self.handle_request(command, parts, transactions)
 
+    def handle_request(self, short_command, parts, transactions):
+        # see https://doc.dovecot.org/2.3/developer_manual/design/dict_protocol/#dovecot-dict-protocol
         if short_command == "L":
             return self.handle_lookup(parts)
         elif short_command == "I":
@@ -34,6 +105,7 @@ class DictProxy:
             return  # no version checking
 
         if short_command not in ("BSC"):
+            msg = format_request(short_command, parts)
             logging.warning(f"unknown dictproxy request: {msg!r}")
             return
 
@@ -46,21 +118,23 @@ class DictProxy:
         elif short_command == "S":
             addr = transactions[transaction_id]["addr"]
             if not self.handle_set(addr, parts):
-                transactions[transaction_id]["res"] = "F\n"
+                transactions[transaction_id]["res"] = REPLY_FAILED
+                msg = format_request(short_command, parts)
                 logging.error(f"dictproxy-set failed for {addr!r}: {msg!r}")
 
     def handle_lookup(self, parts):
         logging.warning(f"lookup ignored: {parts!r}")
-        return "N\n"
+        return REPLY_NOT_FOUND
 
     def handle_iterate(self, parts):
         # Empty line means ITER_FINISHED.
         # If we don't return empty line Dovecot will timeout.
-        return "\n"
+        # Subclasses may return an iterator of strings to stream long results.
+        return REPLY_ITER_FINISHED
 
     def handle_begin_transaction(self, transaction_id, parts, transactions):
         addr = parts[1]
-        transactions[transaction_id] = dict(addr=addr, res="O\n")
+        transactions[transaction_id] = dict(addr=addr, res=REPLY_OK)
 
     def handle_set(self, addr, parts):
         # For documentation on key structure see
@@ -71,7 +145,121 @@ class DictProxy:
         # return whatever "set" command(s) set as result.
         return transactions.pop(transaction_id)["res"]
 
+    async def handle_connection(self, reader, writer, executor):
+        """Serve one dovecot connection from the event loop.
+
+        Request handlers may block (password hashing, file writes),
+        so each batch of received lines is handled on ``executor``,
+        preserving the reply order the dict protocol requires.
+        """
+        transactions = {}
+        pending = b""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                lines, pending = split_lines(pending, data)
+                replies, finished = await loop.run_in_executor(
+                    executor, self.handle_lines, lines, transactions
+                )
+                reply_data = iter_reply_data(replies)
+                while chunk := await loop.run_in_executor(
+                    executor, next, reply_data, None
+                ):
+                    writer.write(chunk)
+                    await writer.drain()
+                if finished:
+                    break
+        except Exception:
+            logging.exception("Exception in the handler")
+        finally:
+            writer.close()
+
+    def serve_forever(self, socket, config):
+        """Serve on the unix ``socket`` path with the engine selected in ``config``."""
+        self.serve_forever_from_listener(get_listener(socket), config)
+
+    def serve_forever_from_listener(self, listener, config):
+        if config.dictproxy_engine == "asyncio":
+            self.serve_forever_async(listener, max_workers=config.dictproxy_workers)
+        else:
+            self.serve_forever_threaded(listener)
+
+    def serve_forever_prefork(self, socket, config, num_workers):
+        """Serve from ``num_workers`` forked processes accepting on one socket.
+
+        Workers that exit are restarted, SIGTERM or SIGINT stops all of them.
+        """
+        listener = get_listener(socket)
+        workers = set()
+        stopping = False
+        stop_signals = {signal.SIGTERM, signal.SIGINT}
+
+        def start_worker():
+            # block stop signals until the new worker is known to the supervisor
+            signal.pthread_sigmask(signal.SIG_BLOCK, stop_signals)
+            pid = os.fork()
+            if pid == 0:
+                for signum in stop_signals:
+                    signal.signal(signum, signal.SIG_DFL)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+                exitcode = 1
+                try:
+                    self.serve_forever_from_listener(listener, config)
+                    exitcode = 0
+                except BaseException:
+                    logging.exception("dictproxy worker failed")
+                finally:
+                    os._exit(exitcode)
+            workers.add(pid)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for pid in list(workers):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    # already reaped by os.wait() but not yet removed
+                    pass
+
+        for signum in stop_signals:
+            signal.signal(signum, stop)
+        for _ in range(num_workers):
+            start_worker()
+
+        while workers:
+            pid, status = os.wait()
+            workers.discard(pid)
+            if not stopping:
+                exitcode = os.waitstatus_to_exitcode(status)
+                logging.error(f"dictproxy worker {pid} exited ({exitcode}), restarting")
+                time.sleep(WORKER_RESTART_DELAY)
+                if not stopping:
+                    start_worker()
+
+    def serve_forever_async(self, listener, max_workers):
+        try:
+            asyncio.run(self._serve_async(listener, max_workers))
+        except KeyboardInterrupt:
+            pass
+
+    async def _serve_async(self, listener, max_workers):
+        with ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="dictproxy"
+        ) as executor:
+            server = await asyncio.start_unix_server(
+                lambda reader, writer: self.handle_connection(reader, writer, executor),
+                sock=listener,
+            )
+            async with server:
+                await server.serve_forever()
+
     def serve_forever_from_socket(self, socket):
+        self.serve_forever_threaded(get_listener(socket))
+
+    def serve_forever_threaded(self, listener):
         dictproxy = self
 
         class Handler(StreamRequestHandler):
@@ -82,12 +270,7 @@ class DictProxy:
                     logging.exception("Exception in the handler")
                     raise
 
-        try:
-            os.unlink(socket)
-        except FileNotFoundError:
-            pass
-
-        with CustomThreadingUnixStreamServer(socket, Handler) as server:
+        with CustomThreadingUnixStreamServer(listener, Handler) as server:
             try:
                 server.serve_forever()
             except KeyboardInterrupt:
@@ -96,3 +279,26 @@ class DictProxy:
 
 class CustomThreadingUnixStreamServer(ThreadingUnixStreamServer):
     request_queue_size = 1000
+
+    def __init__(self, listener, handler_class):
+        # serve on an already listening socket, possibly shared with other processes
+        super().__init__(listener.getsockname(), handler_class, bind_and_activate=False)
+        self.socket.close()
+        self.socket = listener
+
+
+def get_listener(path):
+    """Return the listening socket passed by systemd socket activation,
+    or a new unix socket listening at ``path``."""
+    if os.environ.get("LISTEN_PID") == str(os.getpid()):
+        if int(os.environ.get("LISTEN_FDS", "0")) >= 1:
+            return socket.socket(fileno=SD_LISTEN_FDS_START)
+
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(CustomThreadingUnixStreamServer.request_queue_size)
+    return listener
@@ -1,10 +1,17 @@
+import fcntl
+import hmac
 import json
 import logging
+import multiprocessing
 import os
 import re
 import sys
-
-import filelock
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 
 try:
     import crypt_r
@@ -12,12 +19,22 @@ except ImportError:
     import crypt as crypt_r
 
 from .config import Config, read_config
+from .dictproto import (
+    REPLY_FAILED,
+    REPLY_ITER_FINISHED,
+    REPLY_NOT_FOUND,
+    reply_iter_item,
+    reply_ok,
+    split_and_unescape,
+)
 from .dictproxy import DictProxy
 from .migrate_db import migrate_from_db_to_maildir
 from .syslimits import has_sufficient_resources
 
 NOCREATE_FILE = "/etc/chatmail-nocreate"
 VALID_LOCALPART_RE = re.compile(r"^[a-z0-9._-]+$")
+ITERATE_CHUNK_SIZE = 1000
+SNAPSHOT_RACY_NS = 1_000_000_000
 
 
 def encrypt_password(password: str):
@@ -26,6 +43,73 @@ def encrypt_password(password: str):
     return "{SHA512-CRYPT}" + passhash
 
 
+class PasswordHasher:
+    """Compute password hashes for new accounts on a pool of processes.
+
+    At most ``queue_size`` hashes are pending at any time.
+    Further requests wait up to TIMEOUT seconds for a free slot
+    and are rejected otherwise, so that registration storms
+    do not pile up unbounded work in the dict proxy.
+    With zero ``workers`` hashes are computed in the calling thread.
+    If a worker process dies, the pool is replaced by a new one.
+    """
+
+    TIMEOUT = 5
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        # worker processes are only started once an address is created
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("forkserver"),
+                )
+            return self.executor
+
+    def discard_executor(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def encrypt_password(self, password):
+        """Return the encrypted password or None if too many hashes are pending."""
+        if not self.workers:
+            return encrypt_password(password)
+        if not self.slots.acquire(timeout=self.TIMEOUT):
+            logging.warning(
+                "password hashing queue is full, rejecting account creation"
+            )
+            return None
+        try:
+            for retry in (True, False):
+                executor = self.get_executor()
+                try:
+                    return executor.submit(encrypt_password, password).result()
+                except BrokenProcessPool:
+                    # e.g. a worker was killed by the OOM killer
+                    self.discard_executor(executor)
+                    if not retry:
+                        raise
+                    logging.warning("password hashing pool broke, starting a new one")
+        finally:
+            self.slots.release()
+
+
+def verify_password(password: str, enc_password: str) -> bool:
+    """Return True if password matches the encrypted password."""
+    passhash = enc_password.removeprefix("{SHA512-CRYPT}")
+    if passhash == enc_password:
+        return False
+    return hmac.compare_digest(crypt_r.crypt(password, passhash), passhash)
+
+
 def is_allowed_to_create(config: Config, user, cleartext_password) -> bool:
     """Return True if user and password are admissable."""
     if os.path.exists(NOCREATE_FILE):
@@ -64,36 +148,160 @@ def is_allowed_to_create(config: Config, user, cleartext_password) -> bool:
     return True
 
 
-def split_and_unescape(s):
-    """Split strings using double quote as a separator and backslash as escape character
-    into parts."""
-
-    out = ""
-    i = 0
-    while i < len(s):
-        c = s[i]
-        if c == "\\":
-            # Skip escape character.
-            i += 1
-
-            # This will raise IndexError if there is no character
-            # after escape character. This is expected
-            # as this is an invalid input.
-            out += s[i]
-        elif c == '"':
-            # Separator
-            yield out
-            out = ""
-        else:
-            out += c
-        i += 1
-    yield out
+def scan_addresses(mailboxes_dir):
+    """Yield the addresses of all mailboxes in the mailboxes directory."""
+    with os.scandir(mailboxes_dir) as entries:
+        for entry in entries:
+            if "@" in entry.name:
+                yield entry.name
+
+
+class UserdbCache:
+    """Bounded LRU cache of userdb dicts keyed by address.
+
+    Entries are revalidated with a stat of the password file
+    so that password changes and mailbox removals by other processes
+    are noticed, and are dropped after TTL seconds at the latest.
+    """
+
+    TTL = 3600
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_userdb_dict(self, user):
+        if not self.maxsize:
+            return user.get_userdb_dict()
+        try:
+            st = os.stat(user.password_path)
+        except FileNotFoundError:
+            self.invalidate(user.addr)
+            return {}
+
+        key = (st.st_ino, st.st_size)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user.addr)
+            if entry is not None and entry[0] == key and entry[1] > now:
+                self.entries.move_to_end(user.addr)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        userdata = user.get_userdb_dict()
+        with self.lock:
+            if userdata:
+                self.entries[user.addr] = (key, now + self.TTL, userdata)
+                self.entries.move_to_end(user.addr)
+                if len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+            else:
+                self.entries.pop(user.addr, None)
+        return userdata
+
+    def invalidate(self, addr):
+        with self.lock:
+            self.entries.pop(addr, None)
+
+
+class VerifiedPasswordCache:
+    """Memory-only record of recent successful password verifications.
+
+    Only HMAC digests of address and password are kept,
+    keyed with a random secret that never leaves the process.
+    Entries expire after ``ttl`` seconds
+    and do not match anymore once the encrypted password changes.
+    """
+
+    MAXSIZE = 100000
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.key = os.urandom(32)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_digest(self, addr, password):
+        msg = f"{addr}\0{password}".encode()
+        return hmac.new(self.key, msg, "sha256").digest()
+
+    def verify(self, addr, password, enc_password):
+        digest = self.get_digest(addr, password)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(addr)
+        if entry is not None and entry[1] == enc_password and entry[2] > now:
+            if hmac.compare_digest(entry[0], digest):
+                return True
+
+        if not verify_password(password, enc_password):
+            return False
+        self.remember(addr, password, enc_password)
+        return True
+
+    def remember(self, addr, password, enc_password):
+        """Record that password matches the encrypted password of addr."""
+        digest = self.get_digest(addr, password)
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            self.entries[addr] = (digest, enc_password, expires)
+            self.entries.move_to_end(addr)
+            if len(self.entries) > self.MAXSIZE:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, addr):
+        with self.lock:
+            self.entries.pop(addr, None)
+
+
+class CreationLocks:
+    """Serialize account creation per address.
+
+    Addresses are hashed onto a fixed set of in-process locks.
+    If several doveauth processes serve the same mailboxes,
+    an flock on the mailbox directory additionally excludes other processes.
+    """
+
+    STRIPES = 64
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.locks = [threading.Lock() for _ in range(self.STRIPES)]
+
+    @contextmanager
+    def lock(self, user):
+        with self.locks[hash(user.addr) % self.STRIPES]:
+            if not self.shared:
+                yield
+                return
+            user.maildir.mkdir(parents=True, exist_ok=True)
+            fd = os.open(user.maildir, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                # closing the file descriptor releases the lock
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
 
 
 class AuthDictProxy(DictProxy):
-    def __init__(self, config):
+    def __init__(self, config, shared_locks=False):
         super().__init__()
         self.config = config
+        self.creation_locks = CreationLocks(shared=shared_locks)
+        self.userdb_cache = UserdbCache(maxsize=config.userdb_cache_size)
+        self.verified_passwords = None
+        if config.password_cache_ttl > 0:
+            self.verified_passwords = VerifiedPasswordCache(config.password_cache_ttl)
+        self.userdb_snapshot = None
+        self.password_hasher = PasswordHasher(
+            workers=config.password_hash_workers,
+            queue_size=config.password_hash_queue_size,
+        )
 
     def handle_lookup(self, parts):
         # Dovecot <2.3.17 has only one part,
@@ -101,64 +309,127 @@ class AuthDictProxy(DictProxy):
         keyname = parts[0]
 
         namespace, type, args = keyname.split("/", 2)
-        args = list(split_and_unescape(args))
-
-        config = self.config
-        reply_command = "F"
-        res = ""
-        if namespace == "shared":
-            if type == "userdb":
-                user = args[0]
-                if user.endswith(f"@{config.mail_domain}"):
-                    res = self.lookup_userdb(user)
-                if res:
-                    reply_command = "O"
-                else:
-                    reply_command = "N"
-            elif type == "passdb":
-                user = args[1]
-                if user.endswith(f"@{config.mail_domain}"):
-                    res = self.lookup_passdb(user, cleartext_password=args[0])
-                if res:
-                    reply_command = "O"
-                else:
-                    reply_command = "N"
-        json_res = json.dumps(res) if res else ""
-        return f"{reply_command}{json_res}\n"
+        if namespace != "shared" or type not in ("userdb", "passdb"):
+            return REPLY_FAILED
+        args = split_and_unescape(args)
+
+        res = None
+        domain_suffix = f"@{self.config.mail_domain}"
+        if type == "userdb":
+            user = args[0]
+            if user.endswith(domain_suffix):
+                res = self.lookup_userdb(user)
+        else:
+            user = args[1]
+            if user.endswith(domain_suffix):
+                res = self.lookup_passdb(user, cleartext_password=args[0])
+        return reply_ok(json.dumps(res)) if res else REPLY_NOT_FOUND
 
     def handle_iterate(self, parts):
         # example: I0\t0\tshared/userdb/
         if parts[2] == "shared/userdb/":
-            result = "".join(
-                f"Oshared/userdb/{user}\t\n" for user in self.iter_userdb()
-            )
-            return f"{result}\n"
+            return self.iter_userdb_replies()
+
+    def iter_userdb_replies(self):
+        """Yield iterate replies for all addresses in chunks,
+        followed by the empty line finishing the iteration."""
+        chunk = []
+        for user in self.iter_userdb():
+            chunk.append(reply_iter_item("shared/userdb/" + user))
+            if len(chunk) >= ITERATE_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+        chunk.append(REPLY_ITER_FINISHED)
+        yield "".join(chunk)
+
+    def iter_userdb(self):
+        """Yield all user addresses as they are found in the mailboxes directory.
+
+        With 'userdb_iterate_snapshot' enabled, the addresses of the last
+        full scan are remembered and returned again without a directory scan
+        as long as the directory's mtime does not change.
+        Any change of the mtime causes a new full scan,
+        the snapshot is not updated incrementally.
+        """
+        mailboxes_dir = self.config.mailboxes_dir
+        if not self.config.userdb_iterate_snapshot:
+            yield from scan_addresses(mailboxes_dir)
+            return
+
+        scan_start = time.time_ns()
+        mtime = os.stat(mailboxes_dir).st_mtime_ns
+        snapshot = self.userdb_snapshot
+        if snapshot is not None and snapshot[0] == mtime:
+            yield from snapshot[1]
+            return
 
-    def iter_userdb(self) -> list:
-        """Get a list of all user addresses."""
-        return [x for x in os.listdir(self.config.mailboxes_dir) if "@" in x]
+        addresses = []
+        for addr in scan_addresses(mailboxes_dir):
+            addresses.append(addr)
+            yield addr
+        # a directory changed within the last second may change again
+        # without its mtime advancing, so don't trust such a snapshot
+        if mtime < scan_start - SNAPSHOT_RACY_NS:
+            self.userdb_snapshot = (mtime, addresses)
 
     def lookup_userdb(self, addr):
-        return self.config.get_user(addr).get_userdb_dict()
+        return self.userdb_cache.get_userdb_dict(self.config.get_user(addr))
 
     def lookup_passdb(self, addr, cleartext_password):
         user = self.config.get_user(addr)
-        userdata = user.get_userdb_dict()
+        userdata = self.userdb_cache.get_userdb_dict(user)
         if userdata:
-            return userdata
+            return self.get_passdb_reply(userdata, cleartext_password)
         if not is_allowed_to_create(self.config, addr, cleartext_password):
             return
         if not has_sufficient_resources(self.config):
             return
 
-        lock = filelock.FileLock(str(user.password_path) + ".lock", timeout=5)
-        with lock:
+        # hash outside of the lock so that concurrent creations
+        # of different addresses are not serialized on it
+        enc_password = self.password_hasher.encrypt_password(cleartext_password)
+        if enc_password is None:
+            return
+
+        with self.creation_locks.lock(user):
             userdata = user.get_userdb_dict()
             if userdata:
-                return userdata
-            user.set_password(encrypt_password(cleartext_password))
+                return self.get_passdb_reply(userdata, cleartext_password)
+            user.set_password(enc_password)
+            self.userdb_cache.invalidate(addr)
+            if self.verified_passwords:
+                self.verified_passwords.remember(addr, cleartext_password, enc_password)
             print(f"Created address: {addr}", file=sys.stderr)
-        return user.get_userdb_dict()
+        userdata = self.userdb_cache.get_userdb_dict(user)
+        if self.verified_passwords is None or not userdata:
+            return userdata
+        # the password was just hashed, neither we nor dovecot hash it again
+        return get_nopassword_reply(userdata)
+
+    def get_passdb_reply(self, userdata, cleartext_password):
+        """Return the passdb reply for an existing address.
+
+        With a verified-password cache, the password is checked here
+        and a successful login is answered with "nopassword"
+        so that dovecot does not compute the password hash again.
+        A wrong password is rejected with a not-found reply
+        so that dovecot does not hash it a second time.
+        Dovecot's auth cache keys passdb lookups by address and password,
+        so a cached reply never applies to another password.
+        """
+        if self.verified_passwords is None or not userdata:
+            return userdata
+        addr, enc_password = userdata["addr"], userdata["password"]
+        if not self.verified_passwords.verify(addr, cleartext_password, enc_password):
+            return None
+        return get_nopassword_reply(userdata)
+
+
+def get_nopassword_reply(userdata):
+    """Return a passdb reply that accepts the login without a password check."""
+    reply = {k: v for k, v in userdata.items() if k != "password"}
+    reply["nopassword"] = "Y"
+    return reply
 
 
 def main():
@@ -167,6 +438,11 @@ def main():
 
     migrate_from_db_to_maildir(config)
 
-    dictproxy = AuthDictProxy(config=config)
+    # account creation is serialized across processes when several serve the socket
+    workers = config.doveauth_workers
+    dictproxy = AuthDictProxy(config=config, shared_locks=workers > 1)
 
-    dictproxy.serve_forever_from_socket(socket)
+    if workers > 1:
+        dictproxy.serve_forever_prefork(socket, config, workers)
+    else:
+        dictproxy.serve_forever(socket, config)
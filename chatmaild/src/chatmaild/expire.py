@@ -9,12 +9,17 @@ import shutil
 import sys
 import time
 from argparse import ArgumentParser
-from collections import namedtuple
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from stat import S_ISREG
 
 from chatmaild.config import read_config
+from chatmaild.doveauth import SNAPSHOT_RACY_NS
+from chatmaild.filedict import FileDict
+from chatmaild.metadata import SqliteMetadata, open_metadata
 
 FileEntry = namedtuple("FileEntry", ("path", "mtime", "size"))
 QuotaFileEntry = namedtuple("QuotaFileEntry", ("mtime", "quota_size", "path"))
@@ -22,18 +27,59 @@ QuotaFileEntry = namedtuple("QuotaFileEntry", ("mtime", "quota_size", "path"))
 # Quota cleanup factor of max_mailbox_size. The mailbox is reset to this size.
 QUOTA_CLEANUP_FACTOR = 0.7
 
+# Summaries of the mailboxes as left by the last expiry run,
+# kept next to the mailboxes directory so that writing it
+# does not change the mtime of the directory.
+EXPIRE_INDEX_NAME = "expire-index-{}.json"
+
 # e.g. "cur/1775324677.M448978P3029757.exam,S=3235,W=3305:2,S"
 _dovecot_fn_rex = re.compile(r".+/(\d+)\..+,S=(\d+)")
 
 
-def iter_mailboxes(basedir, maxnum):
+def iter_mailboxes(
+    basedir, maxnum, workers=1, filename_only=False, select=None, skip=None
+):
+    """Yield a MailboxStat for each mailbox in basedir
+    except for those for which ``skip(path)`` returns True.
+
+    With more than one worker, mailboxes are scanned by a pool of threads
+    while results are yielded in directory order as they become ready.
+    """
     if not os.path.exists(basedir):
         print_info(f"no mailboxes found at: {basedir}")
         return
 
-    for name in os_listdir_if_exists(basedir)[:maxnum]:
-        if "@" in name:
-            yield MailboxStat(basedir + "/" + name)
+    paths = [
+        basedir + "/" + name
+        for name in os_listdir_if_exists(basedir)[:maxnum]
+        if "@" in name
+    ]
+
+    def scan(path):
+        if skip is not None and skip(path):
+            return None
+        return MailboxStat(path, filename_only, select)
+
+    if workers <= 1:
+        for path in paths:
+            mbox = scan(path)
+            if mbox is not None:
+                yield mbox
+        return
+
+    # keep a bounded number of scans ahead of the consumer
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(scan, path))
+            if len(pending) >= workers * 4:
+                mbox = pending.popleft().result()
+                if mbox is not None:
+                    yield mbox
+        while pending:
+            mbox = pending.popleft().result()
+            if mbox is not None:
+                yield mbox
 
 
 def get_file_entry(path):
@@ -47,6 +93,26 @@ def get_file_entry(path):
     return FileEntry(path, st.st_mtime, st.st_size)
 
 
+def get_dir_entry(dir_entry):
+    """return a FileEntry for an os.DirEntry or None if it vanished or is not a regular file."""
+    try:
+        if not dir_entry.is_file():
+            return None
+        st = dir_entry.stat()
+    except FileNotFoundError:
+        return None
+    return FileEntry(dir_entry.path, st.st_mtime, st.st_size)
+
+
+def os_scandir_if_exists(path):
+    """return a list of os.DirEntry objects or an empty list if the path is not a directory."""
+    try:
+        with os.scandir(path) as entries:
+            return list(entries)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
 def os_listdir_if_exists(path):
     """return a list of names obtained from os.listdir or an empty list if the path does not exist."""
     try:
@@ -56,32 +122,105 @@ def os_listdir_if_exists(path):
 
 
 class MailboxStat:
-    last_login = None
+    """Messages and other files of a mailbox.
+
+    To keep memory use low for mailboxes with many messages,
+    the mtime, size and folder index of messages are kept in array columns.
+    Filenames are only kept for the messages for which
+    ``select(folder, mtime, size)`` returns True, or for all messages
+    if ``select`` is None.
+
+    With ``filename_only``, the mtime and size of messages with Dovecot maildir
+    filenames are taken from the delivery time and S= size in the filename
+    instead of a stat call.
+    """
 
-    def __init__(self, basedir):
+    __slots__ = (
+        "basedir",
+        "filename_only",
+        "select",
+        "last_login",
+        "folders",
+        "message_folders",
+        "message_mtimes",
+        "message_sizes",
+        "message_names",
+        "extrafiles",
+    )
+
+    def __init__(self, basedir, filename_only=False, select=None):
         self.basedir = str(basedir)
-        self.messages = []
+        self.filename_only = filename_only
+        self.select = select
+        self.last_login = None
+        self.folders = []
+        self.message_folders = array("I")
+        self.message_mtimes = array("d")
+        self.message_sizes = array("q")
+        # message index -> filename
+        self.message_names = {}
         self.extrafiles = []
         self.scandir(self.basedir)
 
+    @property
+    def messages(self):
+        """List of FileEntry for all messages, with a None path
+        for messages whose filenames were not kept."""
+        return list(self.iter_messages())
+
+    def iter_messages(self, selected_only=False):
+        """Yield a FileEntry for each message, or only for the selected ones."""
+        names = self.message_names
+        indexes = sorted(names) if selected_only else range(len(self.message_sizes))
+        for i in indexes:
+            name = names.get(i)
+            path = f"{self.folders[self.message_folders[i]]}/{name}" if name else None
+            yield FileEntry(path, self.message_mtimes[i], self.message_sizes[i])
+
     def scandir(self, folderdir):
-        for name in os_listdir_if_exists(folderdir):
-            path = f"{folderdir}/{name}"
-            if name in ("cur", "new", "tmp"):
-                for msg_name in os_listdir_if_exists(path):
-                    entry = get_file_entry(f"{path}/{msg_name}")
-                    if entry is not None:
-                        self.messages.append(entry)
-            elif os.path.isdir(path):
-                self.scandir(path)
-            else:
-                entry = get_file_entry(path)
+        # directories are recognized from the directory listing (d_type)
+        # so that only files need a stat call
+        for dir_entry in os_scandir_if_exists(folderdir):
+            if not dir_entry.is_dir():
+                entry = get_dir_entry(dir_entry)
                 if entry is not None:
                     self.extrafiles.append(entry)
-                    if name == "password":
+                    if dir_entry.name == "password":
                         self.last_login = entry.mtime
+            elif dir_entry.name in ("cur", "new", "tmp"):
+                self.scan_messages(dir_entry)
+            else:
+                self.scandir(dir_entry.path)
         self.extrafiles.sort(key=lambda x: -x.size)
 
+    def scan_messages(self, folder_entry):
+        folder = folder_entry.path
+        folder_index = len(self.folders)
+        self.folders.append(folder)
+        try:
+            entries = os.scandir(folder)
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        with entries:
+            for msg_entry in entries:
+                quota_entry = None
+                if self.filename_only:
+                    quota_entry = parse_dovecot_filename(
+                        f"{folder_entry.name}/{msg_entry.name}"
+                    )
+                if quota_entry is not None:
+                    mtime, size = quota_entry.mtime, quota_entry.quota_size
+                else:
+                    entry = get_dir_entry(msg_entry)
+                    if entry is None:
+                        continue
+                    mtime, size = entry.mtime, entry.size
+                if self.select is None or self.select(folder, mtime, size):
+                    self.message_names[len(self.message_sizes)] = msg_entry.name
+                self.message_folders.append(folder_index)
+                self.message_mtimes.append(mtime)
+                self.message_sizes.append(size)
+
 
 def parse_dovecot_filename(relpath):
     m = _dovecot_fn_rex.match(relpath)
@@ -100,6 +239,12 @@ def scan_mailbox_messages(mbox):
 
 
 def expire_to_target(mbox, target_bytes):
+    return reduce_to_target(mbox, target_bytes)[0]
+
+
+def reduce_to_target(mbox, target_bytes):
+    """Remove the oldest messages until the mailbox fits into target_bytes
+    and return the number of removed messages and the remaining size."""
     messages = scan_mailbox_messages(mbox)
     total_size = sum(m.quota_size for m in messages)
     # Keep recent 24 hours of messages protected from expiry because
@@ -116,15 +261,31 @@ def expire_to_target(mbox, target_bytes):
         total_size -= entry.quota_size
         removed += 1
 
-    return removed
+    return removed, total_size
 
 
 def print_info(msg):
     print(msg, file=sys.stderr)
 
 
+def get_expire_index(mailboxes_dir):
+    mailboxes_dir = Path(mailboxes_dir)
+    name = EXPIRE_INDEX_NAME.format(mailboxes_dir.name)
+    return FileDict(mailboxes_dir.parent / name)
+
+
 class Expiry:
-    def __init__(self, config, dry, now, verbose):
+    """Expire messages, mailboxes and device tokens.
+
+    A summary of each processed mailbox is kept in the expire index:
+    the mtimes of its directories, its oldest (large) message, last login
+    and size.
+    With ``incremental``, mailboxes whose directories did not change
+    since the last run and where nothing can have expired since
+    are skipped without scanning them.
+    """
+
+    def __init__(self, config, dry, now, verbose, incremental=False):
         self.config = config
         self.dry = dry
         self.now = now
@@ -133,7 +294,124 @@ class Expiry:
         self.all_mboxes = 0
         self.del_files = 0
         self.all_files = 0
+        self.del_tokens = 0
+        self.token_mboxes = 0
+        self.removed_addrs = []
+        self.metadata = open_metadata(config)
         self.start = time.time()
+        self.cutoff_without_login = (
+            now - int(config.delete_inactive_users_after) * 86400
+        )
+        self.cutoff_mails = now - int(config.delete_mails_after) * 86400
+        self.cutoff_large_mails = now - int(config.delete_large_after) * 86400
+        self.target_bytes = (
+            config.max_mailbox_size_mb * 1024 * 1024 * QUOTA_CLEANUP_FACTOR
+        )
+        self.index = get_expire_index(config.mailboxes_dir)
+        self.summaries = self.index.read() if incremental else {}
+        self.new_summaries = {}
+        self.skipped = []
+
+    def can_skip(self, mboxdir):
+        """Return True if the mailbox is unchanged since the last run
+        and neither its messages nor the address can have expired since.
+
+        Called from mailbox scanning threads, only appends to ``skipped``.
+        """
+        name = os.path.basename(mboxdir)
+        summary = self.summaries.get(name)
+        if summary is None:
+            return False
+        # also rechecks mailboxes after max_mailbox_size was lowered
+        size = summary.get("size")
+        if size is None or size > self.target_bytes:
+            return False
+        if (
+            not summary["last_login"]
+            or summary["last_login"] < self.cutoff_without_login
+        ):
+            return False
+        oldest, oldest_large = summary["oldest"], summary["oldest_large"]
+        if oldest is not None and oldest < self.cutoff_mails:
+            return False
+        if oldest_large is not None and oldest_large < self.cutoff_large_mails:
+            return False
+        for relpath, mtime_ns in summary["dirs"].items():
+            try:
+                if os.stat(os.path.join(mboxdir, relpath)).st_mtime_ns != mtime_ns:
+                    return False
+            except FileNotFoundError:
+                return False
+        self.skipped.append(name)
+        return True
+
+    def process_skipped_mailboxes(self):
+        for name in self.skipped:
+            self.all_mboxes += 1
+            self.new_summaries[name] = summary = self.summaries[name]
+            if summary["metadata"]:
+                self.expire_tokens(name)
+
+    def record_summary(self, mbox, total_size):
+        oldest = oldest_large = None
+        folders = mbox.folders
+        for i, mtime in enumerate(mbox.message_mtimes):
+            folder = folders[mbox.message_folders[i]]
+            size = mbox.message_sizes[i]
+            if self.is_expired(folder, mtime, size):
+                # removed in this run
+                continue
+            if oldest is None or mtime < oldest:
+                oldest = mtime
+            if size > 200000 and os.path.basename(folder) == "cur":
+                if oldest_large is None or mtime < oldest_large:
+                    oldest_large = mtime
+
+        dirs = {}
+        paths = {mbox.basedir, *folders, *map(os.path.dirname, folders)}
+        racy_after = time.time_ns() - SNAPSHOT_RACY_NS
+        for path in paths:
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                return
+            # a directory changed within the last second may change again
+            # without its mtime advancing, so scan the mailbox next time
+            if mtime_ns >= racy_after:
+                return
+            dirs[os.path.relpath(path, mbox.basedir)] = mtime_ns
+        extrafiles = [entry.path for entry in mbox.extrafiles]
+        self.new_summaries[os.path.basename(mbox.basedir)] = dict(
+            dirs=dirs,
+            oldest=oldest,
+            oldest_large=oldest_large,
+            last_login=mbox.last_login,
+            size=total_size,
+            metadata=f"{mbox.basedir}/metadata.json" in extrafiles,
+        )
+
+    def save_index(self, prune):
+        """Write the summaries of this run to the expire index
+        and, with ``prune``, drop those of mailboxes that were not seen."""
+        if self.dry:
+            return
+        with self.index.modify() as summaries:
+            if prune:
+                summaries.clear()
+            for name in self.removed_addrs:
+                summaries.pop(name, None)
+            summaries.update(self.new_summaries)
+
+    def is_expired(self, folder, mtime, size):
+        """Return True if a message with mtime and size in the maildir folder expired."""
+        if mtime < self.cutoff_mails:
+            return True
+        # we only remove noticed large files (not unnoticed ones in new/)
+        return (
+            size > 200000
+            and mtime < self.cutoff_large_mails
+            and os.path.basename(folder) == "cur"
+        )
 
     def remove_mailbox(self, mboxdir):
         if self.verbose:
@@ -141,6 +419,28 @@ class Expiry:
         if not self.dry:
             shutil.rmtree(mboxdir)
         self.del_mboxes += 1
+        self.removed_addrs.append(os.path.basename(mboxdir))
+
+    def expire_tokens(self, addr):
+        if isinstance(self.metadata, SqliteMetadata):
+            # swept for all addresses at once by expire_token_database()
+            return
+        removed = self.metadata.expire_tokens(addr, int(self.now), dry=self.dry)
+        if removed:
+            if self.verbose:
+                print_info(f"removing {removed} expired device token(s) of {addr}")
+            self.del_tokens += removed
+            self.token_mboxes += 1
+
+    def expire_token_database(self):
+        """Sweep expired tokens and tokens of removed mailboxes
+        if they are kept in a database instead of the mailboxes."""
+        if isinstance(self.metadata, SqliteMetadata):
+            tokens, addrs = self.metadata.expire_all_tokens(
+                int(self.now), removed_addrs=self.removed_addrs, dry=self.dry
+            )
+            self.del_tokens += tokens
+            self.token_mboxes += addrs
 
     def remove_file(self, path, mtime=None):
         if self.verbose:
@@ -157,15 +457,9 @@ class Expiry:
         self.del_files += 1
 
     def process_mailbox_stat(self, mbox):
-        cutoff_without_login = (
-            self.now - int(self.config.delete_inactive_users_after) * 86400
-        )
-        cutoff_mails = self.now - int(self.config.delete_mails_after) * 86400
-        cutoff_large_mails = self.now - int(self.config.delete_large_after) * 86400
-
         self.all_mboxes += 1
         changed = False
-        if mbox.last_login and mbox.last_login < cutoff_without_login:
+        if mbox.last_login and mbox.last_login < self.cutoff_without_login:
             self.remove_mailbox(mbox.basedir)
             return
         elif mbox.last_login is None:
@@ -180,29 +474,27 @@ class Expiry:
             return
 
         mboxname = os.path.basename(mbox.basedir)
+        for entry in mbox.extrafiles:
+            # doveauth used to leave a lock file behind for each created address
+            if entry.path.endswith("/password.lock"):
+                self.remove_file(entry.path)
+            elif entry.path == f"{mbox.basedir}/metadata.json":
+                self.expire_tokens(mboxname)
+
         if self.verbose:
             date = datetime.fromtimestamp(mbox.last_login) if mbox.last_login else None
             if date:
                 print_info(f"checking mailbox {date.strftime('%b %d')} {mboxname}")
             else:
                 print_info(f"checking mailbox (no last_login) {mboxname}")
-        self.all_files += len(mbox.messages)
-        for message in mbox.messages:
-            if message.mtime < cutoff_mails:
+        self.all_files += len(mbox.message_sizes)
+        for message in mbox.iter_messages(selected_only=True):
+            folder = os.path.dirname(message.path)
+            if self.is_expired(folder, message.mtime, message.size):
                 self.remove_file(message.path, mtime=message.mtime)
-            elif message.size > 200000 and message.mtime < cutoff_large_mails:
-                # we only remove noticed large files (not unnoticed ones in new/)
-                parts = message.path.split("/")
-                if len(parts) >= 2 and parts[-2] == "cur":
-                    self.remove_file(message.path, mtime=message.mtime)
-            else:
-                continue
-            changed = True
+                changed = True
 
-        target_bytes = (
-            self.config.max_mailbox_size_mb * 1024 * 1024 * QUOTA_CLEANUP_FACTOR
-        )
-        removed = expire_to_target(Path(mbox.basedir), target_bytes)
+        removed, total_size = reduce_to_target(Path(mbox.basedir), self.target_bytes)
         if removed:
             changed = True
             self.del_files += removed
@@ -213,12 +505,16 @@ class Expiry:
 
         if changed:
             self.remove_file(f"{mbox.basedir}/maildirsize")
+        if not self.dry:
+            self.record_summary(mbox, total_size)
 
     def get_summary(self):
         return (
             f"Removed {self.del_mboxes} out of {self.all_mboxes} mailboxes "
+            f"({len(self.skipped)} unchanged mailboxes skipped) "
             f"and {self.del_files} out of {self.all_files} files in existing mailboxes "
-            f"in {time.time() - self.start:2.2f} seconds"
+            f"and {self.del_tokens} expired device tokens of {self.token_mboxes} "
+            f"addresses in {time.time() - self.start:2.2f} seconds"
         )
 
 
@@ -256,6 +552,28 @@ def daily_expire_main(args=None):
         action="store_true",
         help="actually remove all expired files and dirs",
     )
+    parser.add_argument(
+        "--full",
+        dest="full",
+        action="store_true",
+        help="scan all mailboxes, also those unchanged since the last run",
+    )
+    parser.add_argument(
+        "--textfile",
+        metavar="PATH",
+        default=None,
+        help="also write the chatmail-fsreport Prometheus textfile to PATH "
+        "(directory or file) from the same scan of all mailboxes",
+    )
+    parser.add_argument(
+        "--legacy-metrics",
+        metavar="FILENAME",
+        nargs="?",
+        const="/var/www/html/metrics",
+        default=None,
+        help="also write the legacy metrics.py textfile from the same scan "
+        "(default: /var/www/html/metrics)",
+    )
     args = parser.parse_args(args)
 
     config = read_config(args.chatmail_ini)
@@ -264,9 +582,39 @@ def daily_expire_main(args=None):
         now = now - 86400 * int(args.days)
 
     maxnum = int(args.maxnum) if args.maxnum else None
-    exp = Expiry(config, dry=not args.remove, now=now, verbose=args.verbose)
-    for mailbox in iter_mailboxes(str(config.mailboxes_dir), maxnum=maxnum):
-        exp.process_mailbox_stat(mailbox)
+    # the report needs all mailboxes with their size on disk
+    report = None
+    if args.textfile or args.legacy_metrics:
+        from chatmaild.fsreport import Report
+
+        report = Report(now=now, min_login_age=0, mdir=None)
+    exp = Expiry(
+        config,
+        dry=not args.remove,
+        now=now,
+        verbose=args.verbose,
+        incremental=not args.full and report is None,
+    )
+    mailboxes = iter_mailboxes(
+        str(config.mailboxes_dir),
+        maxnum=maxnum,
+        workers=config.mailbox_scan_workers,
+        filename_only=config.expire_filename_only and report is None,
+        select=exp.is_expired,
+        skip=exp.can_skip,
+    )
+    # one scan feeds all consumers, the report sees mailboxes before expiry
+    consumers = [exp] if report is None else [report, exp]
+    for mailbox in mailboxes:
+        for consumer in consumers:
+            consumer.process_mailbox_stat(mailbox)
+    exp.process_skipped_mailboxes()
+    exp.expire_token_database()
+    exp.save_index(prune=maxnum is None)
+    if report is not None:
+        from chatmaild.fsreport import dump_textfiles
+
+        dump_textfiles(report, config, args.textfile, args.legacy_metrics)
     print(exp.get_summary())
 
 
@@ -8,34 +8,121 @@ import filelock
 
 
 class FileDict:
-    """Concurrency-safe multi-reader/single-writer persistent dict."""
+    """Concurrency-safe multi-reader/single-writer persistent dict.
 
-    def __init__(self, path):
+    Writers take a lock file and rename a new version into place,
+    readers never take the lock.
+    ``durability`` selects what is synced to disk on each write:
+    "none" only renames, "file" fdatasyncs the new file before renaming it
+    and "dir" additionally fsyncs the directory after the rename.
+    With ``cache=True``, ``read()`` keeps the parsed dict
+    and reuses it as long as a stat shows the file unchanged.
+    ``read_versioned()`` and ``compare_and_swap()`` allow optimistic
+    read-modify-write cycles that only take the lock for writing.
+    """
+
+    DURABILITY_MODES = ("none", "file", "dir")
+
+    def __init__(self, path, durability="none", cache=False):
+        if durability not in self.DURABILITY_MODES:
+            raise ValueError(f"invalid durability mode {durability!r}")
         self.path = path
         self.lock_path = path.with_name(path.name + ".lock")
+        self.durability = durability
+        self.cache = cache
+        self._cached = None
 
     @contextmanager
     def modify(self):
         # the OS will release the lock if the process dies,
         # and the contextmanager will otherwise guarantee release
         with filelock.FileLock(self.lock_path):
-            data = self.read()
+            data = self._parse(self._read_raw())
             yield data
-            write_path = self.path.with_name(self.path.name + ".tmp")
-            with write_path.open("w") as f:
-                json.dump(data, f)
-            os.rename(write_path, self.path)
+            self._write(json.dumps(data).encode())
+
+    def compare_and_swap(self, version, data):
+        """Write data if the file is still at ``version`` and return the new
+        version, or return None if the file was changed since.
+
+        With ``cache=True`` data is kept as the cached dict of the new version,
+        so callers must not modify it afterwards.
+        """
+        with filelock.FileLock(self.lock_path):
+            if self.version() != version:
+                return None
+            self._write(json.dumps(data).encode())
+            new_version = self.version()
+        if self.cache:
+            self._cached = (new_version, data)
+        return new_version
+
+    def version(self):
+        """Return a key that changes with every write, or None without a file."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
 
     def read(self):
+        """Return the stored dict, or an empty one if there is none.
+
+        With ``cache=True`` the same dict is returned for an unchanged file,
+        so callers must not modify it.
+        """
+        return self.read_versioned()[0]
+
+    def read_versioned(self):
+        """Return the stored dict and the version it was read at."""
+        version = self.version()
+        if version is None:
+            return {}, None
+        cached = self._cached
+        if cached is not None and cached[0] == version:
+            return cached[1], version
+        # if the file is replaced after the stat, the data is newer
+        # than the version and a compare_and_swap() will fail
+        data = self._parse(self._read_raw())
+        if self.cache:
+            self._cached = (version, data)
+        return data, version
+
+    def _read_raw(self):
         try:
-            with self.path.open("r") as f:
-                return json.load(f)
+            return self.path.read_bytes()
         except FileNotFoundError:
+            return None
+
+    def _parse(self, raw):
+        if raw is None:
             return {}
+        try:
+            return json.loads(raw)
         except Exception:
             logging.warning(f"corrupt serialization state at: {self.path!r}")
             return {}
 
+    def _write(self, content):
+        write_path = self.path.with_name(self.path.name + ".tmp")
+        with write_path.open("wb") as f:
+            f.write(content)
+            if self.durability != "none":
+                f.flush()
+                os.fdatasync(f.fileno())
+        os.rename(write_path, self.path)
+        if self.durability == "dir":
+            fsync_dir(self.path.parent)
+        self._cached = None
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 
 def write_bytes_atomic(path, content):
     rint = randint(0, 10000000)
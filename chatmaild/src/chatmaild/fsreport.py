@@ -32,6 +32,7 @@ from datetime import datetime
 
 from chatmaild.config import read_config
 from chatmaild.expire import iter_mailboxes
+from chatmaild.syslimits import get_textfile_lines
 
 DAYSECONDS = 24 * 60 * 60
 MONTHSECONDS = DAYSECONDS * 30
@@ -88,15 +89,16 @@ class Report:
         cutoff_login_date = self.now - self.min_login_age * DAYSECONDS
         if last_login and last_login <= cutoff_login_date:
             # categorize message sizes
-            for size in self.message_buckets:
-                for msg in mailbox.messages:
-                    if msg.size >= size:
-                        if self.mdir and f"/{self.mdir}/" not in msg.path:
-                            continue
-                        self.message_buckets[size] += msg.size
+            folders = [f"{folder}/" for folder in mailbox.folders]
+            for msgsize, folder in zip(mailbox.message_sizes, mailbox.message_folders):
+                if self.mdir and f"/{self.mdir}/" not in folders[folder]:
+                    continue
+                for size in self.message_buckets:
+                    if msgsize >= size:
+                        self.message_buckets[size] += msgsize
                         self.message_count_buckets[size] += 1
 
-        self.size_messages += sum(entry.size for entry in mailbox.messages)
+        self.size_messages += sum(mailbox.message_sizes)
         self.size_extra += sum(entry.size for entry in mailbox.extrafiles)
 
     def dump_summary(self):
@@ -152,7 +154,7 @@ class Report:
                 pass
             raise
 
-    def dump_textfile(self, filepath):
+    def dump_textfile(self, filepath, extra_lines=()):
         """Dump metrics in Prometheus exposition format."""
         lines = []
 
@@ -187,6 +189,7 @@ class Report:
         for days, active in self.login_buckets.items():
             lines.append(f'chatmail_accounts_active{{days="{days}"}} {active}')
 
+        lines.extend(extra_lines)
         self._write_atomic(filepath, "\n".join(lines) + "\n")
 
     def dump_compat_textfile(self, filepath):
@@ -206,6 +209,17 @@ class Report:
         self._write_atomic(filepath, "\n".join(lines) + "\n")
 
 
+def dump_textfiles(rep, config, textfile, legacy_metrics):
+    """Write the Prometheus textfile and/or the legacy metrics file if requested."""
+    if textfile:
+        path = textfile
+        if os.path.isdir(path):
+            path = os.path.join(path, "fsreport.prom")
+        rep.dump_textfile(path, extra_lines=get_textfile_lines(config))
+    if legacy_metrics:
+        rep.dump_compat_textfile(legacy_metrics)
+
+
 def main(args=None):
     """Report about filesystem storage usage of all mailboxes and messages"""
     parser = ArgumentParser(description=main.__doc__)
@@ -270,15 +284,16 @@ def main(args=None):
 
     maxnum = int(args.maxnum) if args.maxnum else None
     rep = Report(now=now, min_login_age=int(args.min_login_age), mdir=args.mdir)
-    for mbox in iter_mailboxes(str(config.mailboxes_dir), maxnum=maxnum):
+    mailboxes = iter_mailboxes(
+        str(config.mailboxes_dir),
+        maxnum=maxnum,
+        workers=config.mailbox_scan_workers,
+        # the report needs no message filenames
+        select=lambda folder, mtime, size: False,
+    )
+    for mbox in mailboxes:
         rep.process_mailbox_stat(mbox)
-    if args.textfile:
-        path = args.textfile
-        if os.path.isdir(path):
-            path = os.path.join(path, "fsreport.prom")
-        rep.dump_textfile(path)
-    if args.legacy_metrics:
-        rep.dump_compat_textfile(args.legacy_metrics)
+    dump_textfiles(rep, config, args.textfile, args.legacy_metrics)
     if not args.textfile and not args.legacy_metrics:
         rep.dump_summary()
 
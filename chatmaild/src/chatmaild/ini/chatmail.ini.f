@@ -60,6 +60,10 @@ mail_domain = {mail_domain}
 # Minimum free disk space on the file system holding the mailboxes.
 #min_free_disk_space = 1G
 
+# Seconds for which the load, memory and disk readings
+# used by the three limits above are reused.
+#resource_sample_interval = 5
+
 # Maximum number of concurrent IMAP connections
 # (the Dovecot imap process limit).
 #max_imap_connections = 10000
@@ -69,6 +73,70 @@ mail_domain = {mail_domain}
 # A single client IP may use up to a fifth of this.
 #max_smtp_connections = 1000
 
+#
+# Dict proxy services (doveauth, chatmail-metadata, lastlogin)
+#
+
+# Server engine of the dict proxies that Dovecot connects to.
+# "threads" starts one thread for each Dovecot connection,
+# "asyncio" serves all connections from a single event loop
+# and runs request handlers on a bounded pool of threads.
+#dictproxy_engine = threads
+
+# Number of request handler threads of the "asyncio" engine.
+#dictproxy_workers = 16
+
+# Number of doveauth processes sharing the authentication socket,
+# letting logins and registrations use more than one CPU core.
+# Processes that exit are restarted.
+#doveauth_workers = 1
+
+# Storage of device tokens by chatmail-metadata.
+# "maildir" keeps a metadata.json file in each mailbox,
+# "sqlite" keeps the tokens of all addresses in one database
+# in the mailboxes directory. Switching to "sqlite" moves existing
+# metadata.json files into the database; switching back does not.
+#metadata_backend = maildir
+
+# Number of push notification requests that chatmail-metadata
+# sends concurrently as streams of shared HTTP/2 connections.
+# Requires the optional "httpx[http2]" package (chatmaild[http2]);
+# 0 sends requests over separate HTTP/1.1 connections.
+#notification_http2_streams = 0
+
+# Number of threads with which chatmail-expire and chatmail-fsreport
+# scan mailboxes concurrently, which helps on disks with high latency
+# (1 scans one mailbox after another).
+#mailbox_scan_workers = 4
+
+# set to true to let chatmail-expire take the age and size of messages
+# from the time and S= size in Dovecot's maildir filenames,
+# instead of stat-ing every message file.
+# Files with other names are still stat-ed.
+#expire_filename_only = false
+
+# Number of addresses whose login data doveauth keeps in memory
+# instead of reading the password file on every lookup (0 disables caching).
+#userdb_cache_size = 10000
+
+# set to true to keep the list of all addresses in doveauth's memory,
+# letting repeated "doveadm ... -A" runs skip the mailboxes directory scan
+# while no address was added or removed.
+#userdb_iterate_snapshot = false
+
+# Seconds for which doveauth remembers a successful password check
+# so that frequently reconnecting clients are not hashed on every login.
+# Only keyed digests are kept in memory, never passwords (0 disables the cache).
+#password_cache_ttl = 0
+
+# Number of processes that hash passwords of newly created addresses,
+# letting registrations use all CPU cores (0 hashes within doveauth itself).
+#password_hash_workers = 0
+
+# Maximum number of password hashes waiting for a hashing process;
+# account creations beyond this limit are rejected.
+#password_hash_queue_size = 100
+
 # Use externally managed TLS certificates instead of built-in acmetool.
 # Paths refer to files on the deployment server (not the build machine).
 # Both files must already exist before running cmdeploy.
@@ -26,4 +26,4 @@ def main():
     socket, config_path = sys.argv[1:]
     config = read_config(config_path)
     dictproxy = LastLoginDictProxy(config=config)
-    dictproxy.serve_forever_from_socket(socket)
+    dictproxy.serve_forever(socket, config)
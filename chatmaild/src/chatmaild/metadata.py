@@ -1,14 +1,19 @@
 import json
 import logging
 import socket
+import sqlite3
 import sys
+import threading
 import time
+from collections import OrderedDict
 from contextlib import contextmanager
 from importlib.resources import files
 
 from .config import read_config
+from .dictproto import REPLY_NOT_FOUND, reply_ok
 from .dictproxy import DictProxy
 from .filedict import FileDict
+from .migrate_db import migrate_metadata_to_sqlite
 from .notifier import Notifier
 
 
@@ -32,42 +37,136 @@ def read_appversions(path):
     return json.dumps(data, separators=(",", ":"))
 
 
+# seconds after which a device token is considered invalid
+TOKEN_MAX_AGE = 3600 * 24 * 90
+
+
 def _is_valid_token_timestamp(timestamp, now):
     # Token if invalid after 90 days
     # or if the timestamp is in the future.
-    return timestamp > now - 3600 * 24 * 90 and timestamp < now + 60
+    return timestamp > now - TOKEN_MAX_AGE and timestamp < now + 60
 
 
 class Metadata:
+    """Device tokens of addresses, stored in each mailbox's metadata.json.
+
+    Tokens are kept in an in-memory index that is loaded lazily per address
+    and revalidated with a stat of the metadata file,
+    so that new-message notifications do not read the file again.
+    Token changes are written through with a rename before returning,
+    without syncing, so token registrations cost no fdatasync.
+    Reading tokens never writes: expired tokens are skipped
+    and only removed by the ``chatmail-expire`` sweep through ``expire_tokens()``.
+    """
+
     # each SETMETADATA on this key appends to dictionary
     # mapping of unique device tokens
     # which only ever get removed if the upstream indicates the token is invalid
     DEVICETOKEN_KEY = "devicetoken"
 
+    # maximum number of addresses in the in-memory token index
+    CACHE_SIZE = 100000
+
+    # token writes are serialized per address,
+    # addresses are hashed onto this many locks
+    WRITE_LOCK_STRIPES = 64
+
     def __init__(self, vmail_dir):
         self.vmail_dir = vmail_dir
+        self.token_index = OrderedDict()
+        self.metadata_dicts = OrderedDict()
+        self.index_lock = threading.Lock()
+        self.write_locks = [threading.Lock() for _ in range(self.WRITE_LOCK_STRIPES)]
 
     def get_metadata_dict(self, addr):
-        return FileDict(self.vmail_dir / addr / "metadata.json")
+        # kept per address so that writes reuse the parsed file
+        with self.index_lock:
+            mdict = self.metadata_dicts.get(addr)
+            if mdict is None:
+                path = self.vmail_dir / addr / "metadata.json"
+                mdict = self.metadata_dicts[addr] = FileDict(path, cache=True)
+                if len(self.metadata_dicts) > self.CACHE_SIZE:
+                    self.metadata_dicts.popitem(last=False)
+            else:
+                self.metadata_dicts.move_to_end(addr)
+            return mdict
 
-    @contextmanager
-    def _modify_tokens(self, addr):
-        with self.get_metadata_dict(addr).modify() as data:
-            tokens = data.setdefault(self.DEVICETOKEN_KEY, {})
-            now = int(time.time())
-            if isinstance(tokens, list):
-                data[self.DEVICETOKEN_KEY] = tokens = {t: now for t in tokens}
-
-            expired_tokens = [
-                token
-                for token, timestamp in tokens.items()
-                if not _is_valid_token_timestamp(tokens[token], now)
-            ]
-            for expired_token in expired_tokens:
-                del tokens[expired_token]
+    def _write_lock(self, addr):
+        return self.write_locks[hash(addr) % self.WRITE_LOCK_STRIPES]
+
+    def _version_key(self, addr):
+        """Return a key that changes whenever the stored tokens of addr change."""
+        return self.get_metadata_dict(addr).version()
+
+    def _store_tokens(self, addr, key, tokens):
+        with self.index_lock:
+            self.token_index[addr] = (key, tokens)
+            self.token_index.move_to_end(addr)
+            if len(self.token_index) > self.CACHE_SIZE:
+                self.token_index.popitem(last=False)
 
+    def _get_tokens(self, addr):
+        key = self._version_key(addr)
+        with self.index_lock:
+            entry = self.token_index.get(addr)
+            if entry is not None and entry[0] == key:
+                self.token_index.move_to_end(addr)
+                return entry[1]
+
+        tokens = self._read_tokens(addr)
+        self._store_tokens(addr, key, tokens)
+        return tokens
+
+    def _read_tokens(self, addr):
+        return self._parse_tokens(self.get_metadata_dict(addr).read(), int(time.time()))
+
+    def _parse_tokens(self, data, now):
+        """Return a new dict of the tokens in metadata ``data``."""
+        tokens = data.get(self.DEVICETOKEN_KEY, {})
+        if isinstance(tokens, list):
+            # converted to the timestamped format by the next write
+            return {t: now for t in tokens}
+        elif not isinstance(tokens, dict):
+            return {}
+        return dict(tokens)
+
+    @contextmanager
+    def _modify_tokens(self, addr, now=None):
+        mdict = self.get_metadata_dict(addr)
+        now = int(time.time()) if now is None else now
+        with self._write_lock(addr):
+            data, version = mdict.read_versioned()
+            original = self._parse_tokens(data, now)
+            tokens = {
+                token: timestamp
+                for token, timestamp in original.items()
+                if _is_valid_token_timestamp(timestamp, now)
+            }
             yield tokens
 
+            removed = [token for token in original if token not in tokens]
+            changed = {
+                token: timestamp
+                for token, timestamp in tokens.items()
+                if original.get(token) != timestamp
+            }
+            while True:
+                stored = self._parse_tokens(data, now)
+                for token in removed:
+                    stored.pop(token, None)
+                stored.update(changed)
+                if stored == data.get(self.DEVICETOKEN_KEY, {}):
+                    break
+                new_data = {**data, self.DEVICETOKEN_KEY: stored}
+                new_version = mdict.compare_and_swap(version, new_data)
+                if new_version is not None:
+                    version = new_version
+                    break
+                # another process, e.g. chatmail-expire, wrote in between,
+                # so apply the changes to its version
+                data, version = mdict.read_versioned()
+            self._store_tokens(addr, version, dict(stored))
+
     def add_token_to_addr(self, addr, token):
         with self._modify_tokens(addr) as tokens:
             tokens[token] = int(time.time())
@@ -78,26 +177,184 @@ class Metadata:
                 del tokens[token]
 
     def get_tokens_for_addr(self, addr):
-        mdict = self.get_metadata_dict(addr).read()
-        tokens = mdict.get(self.DEVICETOKEN_KEY, {})
-
         now = int(time.time())
-        if isinstance(tokens, dict):
-            token_list = [
-                token
-                for token, timestamp in tokens.items()
+        return [
+            token
+            for token, timestamp in self._get_tokens(addr).items()
+            if _is_valid_token_timestamp(timestamp, now)
+        ]
+
+    def expire_tokens(self, addr, now, dry=False):
+        """Remove the tokens of addr that are expired at ``now``
+        and return their number."""
+        tokens = self._read_tokens(addr)
+        expired = sum(
+            1
+            for timestamp in tokens.values()
+            if not _is_valid_token_timestamp(timestamp, now)
+        )
+        if expired and not dry:
+            with self._modify_tokens(addr, now=now):
+                pass
+        return expired
+
+
+class SqliteMetadata(Metadata):
+    """Device tokens of all addresses in a single SQLite database.
+
+    The database is kept in WAL mode in the mailboxes directory
+    and indexed by token timestamp,
+    so that expired tokens of all addresses are removed with one statement.
+    """
+
+    DB_NAME = "metadata.sqlite"
+
+    def __init__(self, vmail_dir):
+        super().__init__(vmail_dir)
+        self.db_path = vmail_dir / self.DB_NAME
+        self.db_lock = threading.Lock()
+        # data_version does not change for commits of this connection,
+        # so its writes are counted per address and in bulk
+        self.generations = {}
+        self.bulk_generation = 0
+        self.conn = sqlite3.connect(
+            self.db_path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tokens (
+                addr TEXT NOT NULL,
+                token TEXT NOT NULL,
+                timestamp INTEGER NOT NULL,
+                UNIQUE (addr, token)
+            )
+        """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS tokens_timestamp ON tokens (timestamp)"
+        )
+
+    def close(self):
+        with self.db_lock:
+            self.conn.close()
+
+    def _version_key(self, addr):
+        # changes whenever another connection, e.g. chatmail-expire, commits
+        with self.db_lock:
+            data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            return (data_version, self.bulk_generation, self.generations.get(addr))
+
+    def _bump_generation(self, addr=None):
+        # called after committing, so that a reader that read the old rows
+        # has stored them under an outdated key
+        with self.db_lock:
+            if addr is None:
+                self.bulk_generation += 1
+            else:
+                self.generations[addr] = self.generations.get(addr, 0) + 1
+
+    def _read_tokens(self, addr):
+        with self.db_lock:
+            rows = self.conn.execute(
+                "SELECT token, timestamp FROM tokens WHERE addr = ? ORDER BY rowid",
+                (addr,),
+            ).fetchall()
+        return dict(rows)
+
+    @contextmanager
+    def _modify_tokens(self, addr, now=None):
+        with self._write_lock(addr):
+            original = self._read_tokens(addr)
+            now = int(time.time()) if now is None else now
+            tokens = {
+                token: timestamp
+                for token, timestamp in original.items()
                 if _is_valid_token_timestamp(timestamp, now)
+            }
+            yield tokens
+
+            removed = [(addr, token) for token in original if token not in tokens]
+            changed = [
+                (addr, token, timestamp)
+                for token, timestamp in tokens.items()
+                if original.get(token) != timestamp
             ]
-            if len(token_list) < len(tokens):
-                # Some tokens have expired, remove them.
-                with self._modify_tokens(addr) as _tokens:
-                    pass
-        elif isinstance(tokens, list):
-            with self._modify_tokens(addr) as tokens:
-                token_list = list(tokens.keys())
-        else:
-            token_list = []
-        return token_list
+            with self.db_lock:
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self.conn.executemany(
+                        "DELETE FROM tokens WHERE addr = ? AND token = ?", removed
+                    )
+                    self.conn.executemany(
+                        "INSERT INTO tokens (addr, token, timestamp) VALUES (?, ?, ?)"
+                        " ON CONFLICT (addr, token)"
+                        " DO UPDATE SET timestamp = excluded.timestamp",
+                        changed,
+                    )
+                except BaseException:
+                    self.conn.execute("ROLLBACK")
+                    raise
+                self.conn.execute("COMMIT")
+            self._bump_generation(addr)
+            self._store_tokens(addr, self._version_key(addr), dict(tokens))
+
+    def import_tokens(self, rows):
+        """Insert (addr, token, timestamp) rows, keeping newer stored timestamps."""
+        # per-address writes only delete and update the rows they read,
+        # so bulk statements need no lock beyond the connection's
+        with self.db_lock:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT INTO tokens (addr, token, timestamp) VALUES (?, ?, ?)"
+                    " ON CONFLICT (addr, token) DO UPDATE"
+                    " SET timestamp = max(timestamp, excluded.timestamp)",
+                    rows,
+                )
+        self._bump_generation()
+
+    def expire_all_tokens(self, now, removed_addrs=(), dry=False):
+        """Remove tokens expired at ``now`` and all tokens of ``removed_addrs``
+        and of addresses whose mailbox directory does not exist anymore.
+
+        Returns the number of removed tokens and of addresses they belonged to.
+        """
+        valid_range = (now - TOKEN_MAX_AGE, now + 60)
+        with self.db_lock:
+            rows = self.conn.execute("SELECT DISTINCT addr FROM tokens").fetchall()
+        # e.g. mailboxes that were removed by hand
+        gone = [addr for (addr,) in rows if not (self.vmail_dir / addr).is_dir()]
+        removed_addrs = sorted(set(removed_addrs).union(gone))
+        where = "timestamp <= ? OR timestamp >= ?"
+        with self.db_lock:
+            if dry:
+                addrs = self.conn.execute(
+                    f"SELECT addr FROM tokens WHERE {where}", valid_range
+                ).fetchall()
+                for addr in removed_addrs:
+                    addrs += self.conn.execute(
+                        "SELECT addr FROM tokens WHERE addr = ?", (addr,)
+                    ).fetchall()
+            else:
+                with self.conn:
+                    addrs = self.conn.execute(
+                        f"DELETE FROM tokens WHERE {where} RETURNING addr", valid_range
+                    ).fetchall()
+                    for addr in removed_addrs:
+                        addrs += self.conn.execute(
+                            "DELETE FROM tokens WHERE addr = ? RETURNING addr", (addr,)
+                        ).fetchall()
+        if not dry:
+            self._bump_generation()
+        return len(addrs), len(set(addrs))
+
+
+def open_metadata(config):
+    """Return the device token storage selected by ``metadata_backend``."""
+    if config.metadata_backend == "sqlite":
+        return SqliteMetadata(config.mailboxes_dir)
+    return Metadata(config.mailboxes_dir)
 
 
 class MetadataDictProxy(DictProxy):
@@ -123,29 +380,29 @@ class MetadataDictProxy(DictProxy):
             case ["priv", _, keyname] if keyname == self.metadata.DEVICETOKEN_KEY:
                 addr = parts[1]
                 res = " ".join(self.metadata.get_tokens_for_addr(addr))
-                return f"O{res}\n"
+                return reply_ok(res)
             case ["shared", _, keyname]:
                 prefix = "vendor/vendor.dovecot/pvt/server/vendor/deltachat/"
                 if keyname.startswith(prefix):
                     match keyname[len(prefix) :]:
                         case "irohrelay" if self.iroh_relay:
-                            return f"O{self.iroh_relay}\n"
+                            return reply_ok(self.iroh_relay)
                         case "turn":
                             try:
                                 res = turn_credentials(self.turn_socket_path)
                             except Exception:
                                 logging.exception("failed to get TURN credentials")
-                                return "N\n"
-                            return f"O{self.turn_hostname}:3478:{res}\n"
+                                return REPLY_NOT_FOUND
+                            return reply_ok(f"{self.turn_hostname}:3478:{res}")
                         case "maxsmtprecipients":
                             # postfix default  (see "postconf smtpd_recipient_limit")
-                            return "O1000\n"
+                            return reply_ok("1000")
                         case "appversions":
                             value = read_appversions(self.appversions_path)
-                            return f"O{value}\n" if value else "N\n"
+                            return reply_ok(value) if value else REPLY_NOT_FOUND
 
         logging.warning(f"lookup ignored: {parts!r}")
-        return "N\n"
+        return REPLY_NOT_FOUND
 
     def handle_set(self, addr, parts):
         # For documentation on key structure see
@@ -178,8 +435,10 @@ def main():
 
     queue_dir = vmail_dir / "pending_notifications"
     queue_dir.mkdir(exist_ok=True)
-    metadata = Metadata(vmail_dir)
-    notifier = Notifier(queue_dir)
+    metadata = open_metadata(config)
+    if isinstance(metadata, SqliteMetadata):
+        migrate_metadata_to_sqlite(metadata)
+    notifier = Notifier(queue_dir, http2_streams=config.notification_http2_streams)
     notifier.start_notification_threads(metadata.remove_token_from_addr)
 
     dictproxy = MetadataDictProxy(
@@ -190,4 +449,4 @@ def main():
         turn_socket_path=socket_path,
     )
 
-    dictproxy.serve_forever_from_socket(socket)
+    dictproxy.serve_forever(socket, config)
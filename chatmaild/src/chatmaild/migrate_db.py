@@ -1,12 +1,14 @@
 """
 migration code from old sqlite databases into per-maildir "password" files
-where mtime reflects and is updated to be the "last-login" time.
+where mtime reflects and is updated to be the "last-login" time,
+and from per-maildir "metadata.json" files into the metadata database.
 """
 
 import logging
 import os
 import sqlite3
 import sys
+import time
 
 from chatmaild.config import read_config
 
@@ -57,6 +59,46 @@ def migrate_from_db_to_maildir(config, chunking=10000):
     logging.info(f"migration: moved database to {oldpath!r}")
 
 
+def migrate_metadata_to_sqlite(metadata, chunking=10000):
+    """Move device tokens from per-maildir metadata.json files
+    into the database of a SqliteMetadata instance and remove the files."""
+    rows = []
+    mdicts = []
+    migrated = 0
+
+    def flush():
+        nonlocal migrated
+        metadata.import_tokens(rows)
+        for mdict in mdicts:
+            mdict.path.unlink(missing_ok=True)
+            mdict.lock_path.unlink(missing_ok=True)
+        migrated += len(mdicts)
+        rows.clear()
+        mdicts.clear()
+        logging.info(f"migration-progress: {migrated} metadata files transferred")
+
+    now = int(time.time())
+    for name in os.listdir(metadata.vmail_dir):
+        if "@" not in name:
+            continue
+        mdict = metadata.get_metadata_dict(name)
+        if not mdict.path.exists():
+            continue
+        tokens = mdict.read().get(metadata.DEVICETOKEN_KEY, {})
+        if isinstance(tokens, list):
+            tokens = {token: now for token in tokens}
+        if isinstance(tokens, dict):
+            rows.extend((name, token, int(ts)) for token, ts in tokens.items())
+        mdicts.append(mdict)
+        if len(mdicts) >= chunking:
+            flush()
+
+    if mdicts:
+        flush()
+    if migrated:
+        logging.info(f"migration: all device tokens migrated to {metadata.db_path}")
+
+
 if __name__ == "__main__":
     config = read_config(sys.argv[1])
     logging.basicConfig(level=logging.INFO)
@@ -3,20 +3,38 @@ This modules provides notification machinery for transmitting device tokens to
 a central notification server which in turn contacts a phone provider's notification server
 to trigger Delta Chat apps to retrieve messages and provide instant notifications to users.
 
-The Notifier class arranges the queuing of tokens in separate PriorityQueues
-from which NotifyThreads take and transmit them via HTTPS
-to the `notifications.delta.chat` service.
-The current lack of proper HTTP/2-support in Python leads us
-to use multiple threads and connections to the Rust-implemented `notifications.delta.chat`
-which itself uses HTTP/2 and thus only a single connection to phone-notification providers.
+The Notifier class arranges the queuing of tokens in a single Scheduler
+which releases each of them when it is due to a pool of NotifyThreads
+that transmit them via HTTPS to the `notifications.delta.chat` service.
+The pool grows while due tokens are waiting for a free thread
+and shrinks again when threads stay idle.
+Without the optional httpx dependency, the lack of proper HTTP/2-support in Python
+leads us to use multiple threads and connections to the Rust-implemented
+`notifications.delta.chat` which itself uses HTTP/2
+and thus only a single connection to phone-notification providers.
+With `notification_http2_streams` set, all threads share an HTTP2Session
+which multiplexes their requests as streams of a few HTTP/2 connections.
 
 If a token fails to cause a successful notification
-it is moved to a retry-number specific PriorityQueue
-which handles all tokens that failed a particular number of times
-and which are scheduled for retry using exponential back-off timing.
+it is scheduled for retry using exponential back-off timing
+based on the number of times it failed.
 If a token notification would be scheduled more than DROP_DEADLINE seconds
 after its first attempt, it is dropped with a log error.
 
+Notifications for an address and token that is still waiting for its first attempt
+absorb all later ones, and a token is notified at most once per COALESCE_WINDOW
+so that bursts of messages to the same recipient cause few requests.
+
+All threads share a CircuitBreaker which adapts the number of concurrent requests
+to the health of the notification service.
+While the service is failing, tokens are parked in the Scheduler without
+an attempt, until a single probe request finds the service working again.
+
+Queued tokens are persisted in a QueueJournal in the `pending_notifications`
+directory so that they are sent after a restart.
+On startup they are requeued by a background thread
+while the metadata service already serves requests.
+
 Note that tokens are opaque to the notification machinery here
 and are encrypted foreclosing all ability to distinguish
 which device token ultimately goes to which phone-provider notification service,
@@ -25,14 +43,18 @@ The meaning and format of tokens is basically a matter of chatmail Core and
 the `notification.delta.chat` service.
 """
 
+import asyncio
+import heapq
+import itertools
+import json
 import logging
 import math
 import os
 import time
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from queue import PriorityQueue
-from threading import Thread
+from threading import Condition, Lock, Thread
 from uuid import uuid4
 
 import requests
@@ -40,43 +62,369 @@ import requests
 
 @dataclass
 class PersistentQueueItem:
-    path: Path
+    journal: "QueueJournal" = field(compare=False, repr=False)
+    queue_id: str
     addr: str
     start_ts: int
     token: str
 
     def delete(self):
-        self.path.unlink(missing_ok=True)
-
-    @classmethod
-    def create(cls, queue_dir, addr, start_ts, token):
-        queue_id = uuid4().hex
-        start_ts = int(start_ts)
-        path = queue_dir.joinpath(queue_id)
-        tmp_path = path.with_name(path.name + ".tmp")
-        tmp_path.write_text(f"{addr}\n{start_ts}\n{token}")
-        os.rename(tmp_path, path)
-        return cls(path, addr, start_ts, token)
-
-    @classmethod
-    def read_from_path(cls, path):
-        addr, start_ts, token = path.read_text().split("\n", maxsplit=2)
-        return cls(path, addr, int(start_ts), token)
+        self.journal.ack(self)
+
+    def record(self):
+        return dict(
+            id=self.queue_id, addr=self.addr, ts=self.start_ts, token=self.token
+        )
 
     def __lt__(self, other):
         return self.start_ts < other.start_ts
 
 
+class QueueJournal:
+    """Append-only journal of the queue items that were not sent yet.
+
+    Creating a queue item appends an enqueue record
+    and deleting it appends an ack record to the current segment file,
+    each with a single write.
+    Items without an ack record are returned by ``replay()`` after a restart
+    so that each notification is attempted at least once.
+    When a segment holds many more records than there are pending items,
+    the pending items are copied to a new segment and older segments are removed.
+    """
+
+    SEGMENT_SUFFIX = ".journal"
+    COMPACT_RECORDS = 10000  # minimum records in a segment before compacting
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        self.lock = Lock()
+        self.pending = {}
+        self.fd = None
+        self.seq = max(self.get_segment_seqs(), default=0)
+        self.records = 0
+        # segments up to replay_seq were written by an earlier process
+        # and must not be removed before they were replayed
+        self.replay_seq = self.seq
+        self.replayed = False
+
+    def get_segment_seqs(self):
+        seqs = []
+        for name in os.listdir(self.queue_dir):
+            if name.endswith(self.SEGMENT_SUFFIX):
+                try:
+                    seqs.append(int(name[: -len(self.SEGMENT_SUFFIX)]))
+                except ValueError:
+                    pass
+        return sorted(seqs)
+
+    def get_segment_path(self, seq):
+        return self.queue_dir.joinpath(f"{seq:08d}{self.SEGMENT_SUFFIX}")
+
+    def qsize(self):
+        return len(self.pending)
+
+    def enqueue(self, addr, start_ts, token):
+        queue_item = PersistentQueueItem(self, uuid4().hex, addr, int(start_ts), token)
+        with self.lock:
+            self._append(queue_item.record())
+            self.pending[queue_item.queue_id] = queue_item
+        return queue_item
+
+    def ack(self, queue_item):
+        with self.lock:
+            if self.pending.pop(queue_item.queue_id, None) is None:
+                return
+            self._append(dict(ack=queue_item.queue_id))
+            if self.records > max(self.COMPACT_RECORDS, 2 * len(self.pending)):
+                self._compact()
+
+    def replay(self, drop_before=None, max_workers=1):
+        """Return the items of segments written by earlier processes
+        that were not acknowledged and start a new segment containing only them.
+
+        Segments last written before ``drop_before`` only hold items
+        that are past their deadline and are removed without reading them.
+        """
+        paths = []
+        dropped = 0
+        for seq in self.get_segment_seqs():
+            if seq > self.replay_seq:
+                continue
+            path = self.get_segment_path(seq)
+            if drop_before is not None and path.stat().st_mtime < drop_before:
+                path.unlink()
+                dropped += 1
+            else:
+                paths.append(path)
+        if dropped:
+            logging.error(f"dropped {dropped} journal segment(s) exceeding deadline")
+
+        items = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for records in executor.map(self.read_segment, paths):
+                for record in records:
+                    if isinstance(record, str):
+                        items.pop(record, None)
+                    else:
+                        items[record.queue_id] = record
+        with self.lock:
+            new_items = [item for id, item in items.items() if id not in self.pending]
+            for queue_item in new_items:
+                self.pending[queue_item.queue_id] = queue_item
+            self.replayed = True
+            self._compact()
+        return new_items
+
+    def read_segment(self, path):
+        """Return the queue items and acknowledged queue ids of a segment."""
+        records = []
+        with path.open("rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    if "ack" in record:
+                        records.append(str(record["ack"]))
+                        continue
+                    queue_item = PersistentQueueItem(
+                        self,
+                        record["id"],
+                        record["addr"],
+                        int(record["ts"]),
+                        record["token"],
+                    )
+                except (ValueError, KeyError, TypeError):
+                    logging.warning(f"skipping corrupt record in {path!r}")
+                    continue
+                records.append(queue_item)
+        return records
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def _append(self, record):
+        if self.fd is None:
+            self._open_segment()
+        os.write(self.fd, json.dumps(record).encode() + b"\n")
+        self.records += 1
+
+    def _open_segment(self):
+        self.seq += 1
+        path = self.get_segment_path(self.seq)
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+        self.records = 0
+
+    def _compact(self):
+        # pending items are written to the new segment before older segments
+        # are removed, so that a crash in between only duplicates records
+        old_fd = self.fd
+        self._open_segment()
+        if old_fd is not None:
+            os.close(old_fd)
+        for queue_item in self.pending.values():
+            self._append(queue_item.record())
+        for seq in self.get_segment_seqs():
+            if seq < self.seq and (self.replayed or seq > self.replay_seq):
+                self.get_segment_path(seq).unlink(missing_ok=True)
+
+
+def read_queue_file(path):
+    """Return addr, start_ts and token of a queue file or None if it is invalid."""
+    try:
+        addr, start_ts, token = path.read_text().split("\n", maxsplit=2)
+        return addr, int(start_ts), token
+    except (ValueError, FileNotFoundError):
+        return None
+
+
+class Scheduler:
+    """Time-ordered queue that releases each entry once it is due.
+
+    Entries are kept in a heap ordered by due time.
+    ``get()`` blocks until the earliest entry is due
+    and waiting callers are woken up when an earlier entry is added.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = Condition()
+        self.closed = False
+        self.idle = 0
+
+    def put(self, when, entry):
+        with self.cond:
+            heapq.heappush(self.heap, (when, next(self.counter), entry))
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """Return ``(when, entry)`` of a due entry, or None
+        if the scheduler is closed or no entry got due within ``timeout`` seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            self.idle += 1
+            try:
+                while not self.closed:
+                    wait = None
+                    if self.heap:
+                        now = self.clock()
+                        wait = self.heap[0][0] - now
+                        if wait <= 0:
+                            when, _, entry = heapq.heappop(self.heap)
+                            if self.heap and self.heap[0][0] <= now:
+                                self.cond.notify()
+                            return when, entry
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return None
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self.cond.wait(wait)
+                return None
+            finally:
+                self.idle -= 1
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def qsize(self):
+        return len(self.heap)
+
+    def next_due(self):
+        with self.cond:
+            return self.heap[0][0] if self.heap else None
+
+    def entries(self):
+        with self.cond:
+            return [entry for when, _, entry in sorted(self.heap)]
+
+    def needs_worker(self):
+        """Return True if a due entry is waiting and nobody is waiting to get it."""
+        with self.cond:
+            return bool(self.heap) and self.heap[0][0] <= self.clock() and not self.idle
+
+    def get_stats(self):
+        """Return the number of queued and due entries
+        and the seconds by which the oldest due entry is late."""
+        with self.cond:
+            now = self.clock()
+            due = sum(1 for when, _, _ in self.heap if when <= now)
+            lag = now - self.heap[0][0] if due else 0
+            return len(self.heap), due, lag
+
+
+class CircuitBreaker:
+    """Concurrency limit and circuit breaker shared by all notification threads.
+
+    The number of concurrent requests is limited with
+    additive increase on success and multiplicative decrease on failure.
+    After FAILURE_THRESHOLD consecutive failures the circuit opens
+    and no requests are let through for OPEN_TIMEOUT seconds.
+    Then a single probe request is let through (half-open)
+    whose outcome closes the circuit or opens it again.
+    """
+
+    FAILURE_THRESHOLD = 5  # consecutive failures that open the circuit
+    OPEN_TIMEOUT = 30  # seconds until an open circuit lets a probe through
+    LIMITED_DELAY = 1  # seconds to wait if the concurrency limit is reached
+
+    def __init__(self, max_limit, min_limit=1, clock=time.monotonic):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = max_limit
+        self.clock = clock
+        self.lock = Lock()
+        self.in_flight = 0
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def has_capacity(self):
+        with self.lock:
+            return self.opened_at is None and self.in_flight < int(self.limit)
+
+    def acquire(self):
+        """Return True if a request may be sent now, which must be followed
+        by a ``release()`` call, or False if the request should be parked."""
+        with self.lock:
+            if self.opened_at is not None:
+                if self.probing or self.clock() < self.opened_at + self.OPEN_TIMEOUT:
+                    return False
+                self.probing = True
+            elif self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, success):
+        with self.lock:
+            self.in_flight -= 1
+            if success:
+                if self.opened_at is not None:
+                    logging.info("notification service recovered, closing circuit")
+                self.failures = 0
+                self.opened_at = None
+                self.probing = False
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                return
+            self.failures += 1
+            self.limit = max(self.min_limit, self.limit / 2)
+            if self.probing or self.failures >= self.FAILURE_THRESHOLD:
+                if self.opened_at is None:
+                    logging.warning("notification service failing, opening circuit")
+                self.opened_at = self.clock()
+                self.probing = False
+
+    def get_delay(self):
+        """Return the seconds after which a parked request should be tried again."""
+        with self.lock:
+            if self.opened_at is None:
+                return self.LIMITED_DELAY
+            wait = self.opened_at + self.OPEN_TIMEOUT - self.clock()
+            return wait if wait > 0 else self.OPEN_TIMEOUT
+
+
 class Notifier:
     URL = "https://notifications.delta.chat/notify"
     CONNECTION_TIMEOUT = 60.0  # seconds until http-request is given up
     BASE_DELAY = 8.0  # base seconds for exponential back-off delay
     DROP_DEADLINE = 5 * 60 * 60  #  drop notifications after 5 hours
+    COALESCE_WINDOW = 1  # minimum seconds between attempts for the same token
+    MIN_WORKERS = 4  # notification threads that are kept running when idle
+    MAX_WORKERS = 32  # maximum number of notification threads
+    WORKER_IDLE_TIMEOUT = 60  # seconds after which surplus idle threads exit
+    STATS_INTERVAL = 300  # seconds between logging queue statistics
+    RECOVERY_THREADS = 8  # threads reading queued notifications on startup
 
-    def __init__(self, queue_dir):
+    def __init__(self, queue_dir, http2_streams=0):
         self.queue_dir = queue_dir
-        max_tries = int(math.log(self.DROP_DEADLINE, self.BASE_DELAY)) + 1
-        self.retry_queues = [PriorityQueue() for _ in range(max_tries)]
+        self.journal = QueueJournal(queue_dir)
+        self.http2_streams = http2_streams
+        self.http2_session = None
+        self.max_tries = int(math.log(self.DROP_DEADLINE, self.BASE_DELAY)) + 1
+        self.scheduler = Scheduler()
+        self.breaker = CircuitBreaker(self.MAX_WORKERS)
+        self.remove_token_from_addr = None
+        self.recovery_thread = None
+        self.workers = set()
+        self.max_workers = self.MAX_WORKERS
+        self.workers_lock = Lock()
+        self.max_lag = 0
+        self.last_stats = time.monotonic()
+        # (addr, token) -> queue item that was not attempted yet
+        self.pending = {}
+        # (addr, token) -> time of the last attempt within COALESCE_WINDOW
+        self.last_attempts = {}
+        self.coalesce_lock = Lock()
+        self.coalesced = 0
 
     def compute_delay(self, retry_num):
         return 0 if retry_num == 0 else pow(self.BASE_DELAY, retry_num)
@@ -84,83 +432,252 @@ class Notifier:
     def new_message_for_addr(self, addr, metadata):
         start_ts = int(time.time())
         for token in metadata.get_tokens_for_addr(addr):
-            queue_item = PersistentQueueItem.create(
-                self.queue_dir, addr, start_ts, token
-            )
-            self.queue_for_retry(queue_item)
+            key = (addr, token)
+            with self.coalesce_lock:
+                if key in self.pending:
+                    self.coalesced += 1
+                    continue
+                # reserve the key while the queue item file is written
+                self.pending[key] = None
+                last_attempt = self.last_attempts.get(key)
+            try:
+                queue_item = self.journal.enqueue(addr, start_ts, token)
+            except BaseException:
+                # let the next message try again
+                with self.coalesce_lock:
+                    del self.pending[key]
+                raise
+            with self.coalesce_lock:
+                self.pending[key] = queue_item
+            not_before = None
+            if last_attempt is not None:
+                not_before = math.ceil(last_attempt + self.COALESCE_WINDOW)
+            self.queue_for_retry(queue_item, not_before=not_before)
+
+    def forget_pending(self, queue_item):
+        key = (queue_item.addr, queue_item.token)
+        with self.coalesce_lock:
+            if self.pending.get(key) is queue_item:
+                del self.pending[key]
+
+    def start_attempt(self, queue_item):
+        """Record that queue_item is being sent,
+        so that later messages cause a new notification."""
+        self.forget_pending(queue_item)
+        key = (queue_item.addr, queue_item.token)
+        now = time.time()
+        with self.coalesce_lock:
+            self.last_attempts[key] = now
+            if len(self.last_attempts) > 10000:
+                cutoff = now - self.COALESCE_WINDOW
+                self.last_attempts = {
+                    k: t for k, t in self.last_attempts.items() if t > cutoff
+                }
 
     def requeue_persistent_queue_items(self):
-        for queue_path in self.queue_dir.iterdir():
-            if queue_path.name.endswith(".tmp"):
-                logging.warning(f"removing spurious queue item: {queue_path!r}")
-                queue_path.unlink()
-                continue
-            try:
-                queue_item = PersistentQueueItem.read_from_path(queue_path)
-            except ValueError:
-                logging.warning(f"removing spurious queue item: {queue_path!r}")
-                queue_path.unlink()
-                continue
+        drop_before = time.time() - self.DROP_DEADLINE
+        queue_items = self.journal.replay(drop_before, self.RECOVERY_THREADS)
+        queue_items += self.migrate_queue_files(drop_before)
+        for queue_item in queue_items:
+            key = (queue_item.addr, queue_item.token)
+            with self.coalesce_lock:
+                if key in self.pending:
+                    self.coalesced += 1
+                    queue_item.delete()
+                    continue
+                self.pending[key] = queue_item
             self.queue_for_retry(queue_item)
+        if queue_items:
+            logging.info(f"requeued {len(queue_items)} pending notifications")
+
+    def migrate_queue_files(self, drop_before=None):
+        """Move queue items stored as one file each by earlier versions
+        into the journal and return them.
+
+        Files last modified before ``drop_before`` are removed without reading them.
+        """
+        paths = []
+        dropped = 0
+        with os.scandir(self.queue_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(QueueJournal.SEGMENT_SUFFIX):
+                    continue
+                if entry.name.endswith(".tmp"):
+                    logging.warning(f"removing spurious queue item: {entry.path!r}")
+                    os.unlink(entry.path)
+                elif drop_before is not None and entry.stat().st_mtime < drop_before:
+                    os.unlink(entry.path)
+                    dropped += 1
+                else:
+                    paths.append(Path(entry.path))
+        if dropped:
+            logging.error(f"dropped {dropped} queue item(s) exceeding deadline")
+
+        queue_items = []
+        with ThreadPoolExecutor(max_workers=self.RECOVERY_THREADS) as executor:
+            for path, res in zip(paths, executor.map(read_queue_file, paths)):
+                if res is None:
+                    logging.warning(f"removing spurious queue item: {path!r}")
+                else:
+                    queue_items.append(self.journal.enqueue(*res))
+                path.unlink(missing_ok=True)
+        return queue_items
 
-    def queue_for_retry(self, queue_item, retry_num=0):
-        delay = self.compute_delay(retry_num)
-        when = int(time.time()) + delay
+    def start_recovery(self):
+        """Requeue pending notifications in a background thread."""
+        self.recovery_thread = Thread(
+            target=self.requeue_persistent_queue_items, daemon=True
+        )
+        self.recovery_thread.start()
+
+    def queue_for_retry(self, queue_item, retry_num=0, not_before=None, delay=None):
+        if delay is None:
+            delay = self.compute_delay(retry_num)
+        when = int(self.scheduler.clock()) + delay
+        if not_before is not None:
+            when = max(when, not_before)
         deadline = queue_item.start_ts + self.DROP_DEADLINE
-        if retry_num >= len(self.retry_queues) or when > deadline:
+        if retry_num >= self.max_tries or when > deadline:
+            self.forget_pending(queue_item)
             queue_item.delete()
             logging.error(f"notification exceeded deadline: {queue_item.token!r}")
             return
 
-        self.retry_queues[retry_num].put((when, queue_item))
+        self.scheduler.put(when, (retry_num, queue_item))
+        self.grow_pool()
+
+    def new_session(self):
+        """Return the session a notification thread sends its requests with."""
+        if self.http2_session is not None:
+            return self.http2_session
+        return requests.Session()
 
     def start_notification_threads(self, remove_token_from_addr):
-        self.requeue_persistent_queue_items()
-        threads = {}
-        for retry_num in range(len(self.retry_queues)):
-            # use 4 threads for first-try tokens and less for subsequent tries
-            num_threads = 4 if retry_num == 0 else 2
-            threads[retry_num] = []
-            for _ in range(num_threads):
-                thread = NotifyThread(self, retry_num, remove_token_from_addr)
-                threads[retry_num].append(thread)
-                thread.start()
-        return threads
+        if self.http2_streams > 0:
+            try:
+                self.http2_session = HTTP2Session(self.http2_streams)
+            except ImportError:
+                logging.warning("httpx[http2] is not installed, not using HTTP/2")
+            else:
+                # each thread waits for one stream of the shared connections
+                self.max_workers = max(self.MAX_WORKERS, self.http2_streams)
+                self.breaker.max_limit = self.breaker.limit = self.max_workers
+
+        self.remove_token_from_addr = remove_token_from_addr
+        for _ in range(self.MIN_WORKERS):
+            self.add_worker()
+        self.start_recovery()
+        return list(self.workers)
+
+    def stop_notification_threads(self):
+        if self.recovery_thread is not None:
+            self.recovery_thread.join()
+        self.scheduler.close()
+        for thread in list(self.workers):
+            thread.join()
+
+    def add_worker(self):
+        with self.workers_lock:
+            if len(self.workers) >= self.max_workers or self.scheduler.closed:
+                return
+            thread = NotifyThread(self, self.remove_token_from_addr)
+            self.workers.add(thread)
+        thread.start()
+
+    def retire_worker(self, thread):
+        """Remove an idle thread from the pool unless it is needed
+        to keep MIN_WORKERS running and return True if it was removed."""
+        with self.workers_lock:
+            if self.scheduler.closed or len(self.workers) > self.MIN_WORKERS:
+                self.workers.discard(thread)
+                return True
+            return False
+
+    def grow_pool(self):
+        """Start another thread if a due entry finds all running threads busy."""
+        with self.workers_lock:
+            running = bool(self.workers)
+        if running and self.breaker.has_capacity() and self.scheduler.needs_worker():
+            self.add_worker()
+
+    def item_released(self, when):
+        """Called by a notification thread that took an entry due at ``when``."""
+        lag = self.scheduler.clock() - when
+        with self.workers_lock:
+            self.max_lag = max(self.max_lag, lag)
+        self.grow_pool()
+        if time.monotonic() - self.last_stats > self.STATS_INTERVAL:
+            self.log_stats()
+
+    def get_stats(self):
+        queued, due, lag = self.scheduler.get_stats()
+        with self.workers_lock:
+            max_lag, self.max_lag = self.max_lag, 0
+            workers = len(self.workers)
+        return dict(
+            queued=queued,
+            due=due,
+            lag=lag,
+            max_lag=max_lag,
+            workers=workers,
+            coalesced=self.coalesced,
+            limit=self.breaker.limit,
+            circuit_open=self.breaker.is_open(),
+        )
+
+    def log_stats(self):
+        self.last_stats = time.monotonic()
+        stats = " ".join(f"{key}={value:g}" for key, value in self.get_stats().items())
+        logging.info(f"notification queue: {stats}")
 
 
 class NotifyThread(Thread):
-    def __init__(self, notifier, retry_num, remove_token_from_addr):
+    def __init__(self, notifier, remove_token_from_addr):
         super().__init__(daemon=True)
         self.notifier = notifier
-        self.retry_num = retry_num
         self.remove_token_from_addr = remove_token_from_addr
 
-    def stop(self):
-        self.notifier.retry_queues[self.retry_num].put((None, None))
-
     def run(self):
-        requests_session = requests.Session()
-        while self.retry_one(requests_session):
-            pass
+        requests_session = self.notifier.new_session()
+        while True:
+            timeout = self.notifier.WORKER_IDLE_TIMEOUT
+            if not self.retry_one(requests_session, timeout=timeout):
+                if self.notifier.retire_worker(self):
+                    break
 
-    def retry_one(self, requests_session, sleep=time.sleep):
-        when, queue_item = self.notifier.retry_queues[self.retry_num].get()
-        if when is None:
+    def retry_one(self, requests_session, timeout=None):
+        """Send the next due notification and return True,
+        or return False if none got due within ``timeout`` seconds."""
+        res = self.notifier.scheduler.get(timeout=timeout)
+        if res is None:
             return False
-        wait_time = when - int(time.time())
-        if wait_time > 0:
-            sleep(wait_time)
-        self.perform_request_to_notification_server(requests_session, queue_item)
+        when, (retry_num, queue_item) = res
+        self.notifier.item_released(when)
+        self.perform_request_to_notification_server(
+            requests_session, queue_item, retry_num
+        )
         return True
 
-    def perform_request_to_notification_server(self, requests_session, queue_item):
+    def perform_request_to_notification_server(
+        self, requests_session, queue_item, retry_num=0
+    ):
+        breaker = self.notifier.breaker
+        if not breaker.acquire():
+            # park the item without counting an attempt
+            delay = breaker.get_delay()
+            self.notifier.queue_for_retry(queue_item, retry_num, delay=delay)
+            return
         timeout = self.notifier.CONNECTION_TIMEOUT
         token = queue_item.token
+        self.notifier.start_attempt(queue_item)
         try:
             res = requests_session.post(self.notifier.URL, data=token, timeout=timeout)
         except requests.exceptions.RequestException as e:
+            breaker.release(success=False)
             res = e
         else:
+            # the service is healthy if it answers other than with a server error
+            breaker.release(success=res.status_code < 500 and res.status_code != 429)
             if res.status_code in (200, 410):
                 if res.status_code == 410:
                     self.remove_token_from_addr(queue_item.addr, token)
@@ -168,4 +685,48 @@ class NotifyThread(Thread):
                 return
 
         logging.warning(f"Notification request failed: {res!r}")
-        self.notifier.queue_for_retry(queue_item, retry_num=self.retry_num + 1)
+        self.notifier.queue_for_retry(queue_item, retry_num=retry_num + 1)
+
+
+class HTTP2Session:
+    """Session with a ``post()`` like ``requests.Session``
+    that multiplexes concurrent requests as streams of HTTP/2 connections.
+
+    Requests run on an event loop in a background thread,
+    at most ``max_streams`` of them at a time.
+    Transport errors are raised as ``requests.exceptions.ConnectionError``.
+    """
+
+    MAX_CONNECTIONS = 4
+
+    def __init__(self, max_streams, http1=True):
+        import httpx
+
+        self.httpx = httpx
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        limits = httpx.Limits(max_connections=self.MAX_CONNECTIONS)
+        self.client = httpx.AsyncClient(http2=True, http1=http1, limits=limits)
+        self.semaphore = self._run(self._make_semaphore(max_streams))
+
+    async def _make_semaphore(self, max_streams):
+        return asyncio.Semaphore(max_streams)
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def post(self, url, data, timeout):
+        return self._run(self._post(url, data, timeout))
+
+    async def _post(self, url, data, timeout):
+        async with self.semaphore:
+            try:
+                return await self.client.post(url, content=data, timeout=timeout)
+            except self.httpx.HTTPError as e:
+                raise requests.exceptions.ConnectionError(repr(e)) from e
+
+    def close(self):
+        self._run(self.client.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
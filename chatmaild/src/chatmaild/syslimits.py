@@ -1,11 +1,18 @@
 """Detect whether the system is at its limits."""
 
 import logging
+import threading
+import time
+from collections import namedtuple
 
 import psutil
 
 MB = 1024 * 1024
 
+# load average and available memory/free disk space in bytes,
+# each None if it could not be read
+Readings = namedtuple("Readings", ("load", "mem", "disk"))
+
 
 def read_value(getter):
     try:
@@ -15,11 +22,61 @@ def read_value(getter):
         return None
 
 
+def read_resources(path):
+    """Return current Readings for the system and the file system holding path."""
+    return Readings(
+        load=read_value(lambda: psutil.getloadavg()[0]),
+        mem=read_value(lambda: psutil.virtual_memory().available),
+        disk=read_value(lambda: psutil.disk_usage(path).free),
+    )
+
+
+class ResourceSampler:
+    """Resource readings that are refreshed at most once per interval.
+
+    While one thread refreshes the readings,
+    other threads keep getting the previous ones instead of waiting.
+    """
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.readings = None
+        self.expires = 0
+        self.refresh_lock = threading.Lock()
+
+    def get_readings(self):
+        readings = self.readings
+        if readings is not None and time.monotonic() < self.expires:
+            return readings
+        if self.refresh_lock.acquire(blocking=readings is None):
+            try:
+                self.readings = read_resources(self.path)
+                self.expires = time.monotonic() + self.interval
+            finally:
+                self.refresh_lock.release()
+        return self.readings
+
+
+_samplers = {}
+_samplers_lock = threading.Lock()
+
+
+def get_sampler(config):
+    """Return the process-wide sampler for the mailboxes directory of config."""
+    key = (str(config.mailboxes_dir), config.resource_sample_interval)
+    with _samplers_lock:
+        sampler = _samplers.get(key)
+        if sampler is None:
+            sampler = _samplers[key] = ResourceSampler(*key)
+        return sampler
+
+
 def has_sufficient_resources(config):
     """Return False if load, memory or disk exceeds a configured limit."""
-    load = read_value(lambda: psutil.getloadavg()[0])
-    mem = read_value(lambda: psutil.virtual_memory().available // MB)
-    disk = read_value(lambda: psutil.disk_usage(str(config.mailboxes_dir)).free // MB)
+    load, mem, disk = get_sampler(config).get_readings()
+    mem = mem // MB if mem is not None else None
+    disk = disk // MB if disk is not None else None
     if load is not None and load > config.max_load_1m:
         msg = f"load avg {load:.2f} > {config.max_load_1m:.2f}"
     elif mem is not None and mem < config.min_available_memory_mb:
@@ -30,3 +87,28 @@ def has_sufficient_resources(config):
         return True
     logging.warning("registration rejected: %s", msg)
     return False
+
+
+def get_textfile_lines(config):
+    """Return Prometheus exposition lines for free disk space and limits.
+
+    The textfile is written by the daily fsreport run,
+    so load and available memory, which change within seconds,
+    are left to the node exporter.
+    """
+    disk = get_sampler(config).get_readings().disk
+    lines = []
+
+    lines.append("# HELP chatmail_system_bytes Free disk space.")
+    lines.append("# TYPE chatmail_system_bytes gauge")
+    if disk is not None:
+        lines.append(f'chatmail_system_bytes{{kind="disk"}} {disk}')
+
+    lines.append("# HELP chatmail_system_limit Limits for creating new addresses.")
+    lines.append("# TYPE chatmail_system_limit gauge")
+    lines.append(f'chatmail_system_limit{{kind="load1"}} {config.max_load_1m}')
+    memory_limit = config.min_available_memory_mb * MB
+    lines.append(f'chatmail_system_limit{{kind="memory"}} {memory_limit}')
+    disk_limit = config.min_free_disk_space_mb * MB
+    lines.append(f'chatmail_system_limit{{kind="disk"}} {disk_limit}')
+    return lines
@@ -0,0 +1,125 @@
+"""
+Micro-benchmarks for chatmaild hot paths, not run as part of the test suite.
+
+example invocation:
+
+    pytest src/chatmaild/tests/benchmark.py
+
+"""
+
+import os
+import time
+
+import pytest
+
+from chatmaild.dictproto import parse_request, reply_iter_item, split_and_unescape
+from chatmaild.dictproxy import DictProxy
+from chatmaild.doveauth import AuthDictProxy, verify_password
+from chatmaild.expire import iter_mailboxes
+
+
+@pytest.fixture
+def ops_per_second(capsys):
+    def measure(func, num, name):
+        start = time.perf_counter()
+        for _ in range(num):
+            func()
+        rate = num / (time.perf_counter() - start)
+        with capsys.disabled():
+            print(f"\n{name: <40} {rate:12.0f} ops/s")
+        return rate
+
+    return measure
+
+
+@pytest.fixture(scope="module")
+def mailbox_tree(tmp_path_factory):
+    """Synthetic mailboxes directory, by default with 100k mailboxes.
+
+    Set CHATMAIL_BENCH_MAILBOXES to use another number of mailboxes.
+    """
+    num = int(os.environ.get("CHATMAIL_BENCH_MAILBOXES", "100000"))
+    basedir = tmp_path_factory.mktemp("mailboxes")
+    now = int(time.time())
+    for i in range(num):
+        mboxdir = basedir.joinpath(f"user{i:06}@chat.example.org")
+        mboxdir.mkdir()
+        mboxdir.joinpath("password").write_text("x")
+        mboxdir.joinpath("dovecot.index.log").write_text("x" * 100)
+        for sub in ("cur", "new", "tmp"):
+            mboxdir.joinpath(sub).mkdir()
+        for j in range(i % 5):
+            name = f"{now - j * 86400}.M{j}P{i}.host,S=1000,W=1020:2,S"
+            mboxdir.joinpath("cur", name).write_text("x" * 1000)
+        if i % 3 == 0:
+            mboxdir.joinpath("new", f"{now}.M0P{i}.host,S=500,W=510").write_text("x")
+    return basedir, num
+
+
+@pytest.mark.parametrize("workers", [1, 4, 16])
+def test_expire_mailbox_walk(mailbox_tree, ops_per_second, workers):
+    basedir, num = mailbox_tree
+    mailboxes = iter_mailboxes(str(basedir), maxnum=None, workers=workers)
+    ops_per_second(
+        lambda: next(mailboxes), num, f"walk {num} mailboxes ({workers} workers)"
+    )
+
+
+@pytest.mark.parametrize("ttl", ["0", "60"], ids=["uncached", "cached"])
+def test_passdb_logins(make_config, gencreds, ops_per_second, ttl):
+    config = make_config("chat.example.org", {"password_cache_ttl": ttl})
+    dictproxy = AuthDictProxy(config=config)
+    addr, password = gencreds()
+    dictproxy.lookup_passdb(addr, password)
+    if dictproxy.verified_passwords is None:
+        # without the cache, dovecot verifies the returned password hash itself
+        def login():
+            userdata = dictproxy.lookup_passdb(addr, password)
+            assert verify_password(password, userdata["password"])
+    else:
+
+        def login():
+            assert dictproxy.lookup_passdb(addr, password)["nopassword"]
+
+    ops_per_second(login, 200, f"passdb logins ({ttl}s password cache)")
+
+
+def test_dictproto_lookup(ops_per_second):
+    line = b'Lshared/passdb/laksjdlak\\"sjdlk12j3l1"some42123@chat.example.org'
+    line += b"\tsome42123@chat.example.org\n"
+
+    def parse_lookup():
+        command, parts = parse_request(line)
+        split_and_unescape(parts[0].split("/", 2)[2])
+
+    ops_per_second(parse_lookup, 100000, "dict lookup parsing")
+
+
+def test_dictproto_iterate(ops_per_second):
+    users = [f"user{i:05}@chat.example.org" for i in range(1000)]
+
+    def encode_iterate():
+        "".join(reply_iter_item("shared/userdb/" + user) for user in users)
+
+    ops_per_second(encode_iterate, 1000, "dict iterate 1000 replies")
+
+
+def test_dictproto_transaction(ops_per_second):
+    dictproxy = DictProxy()
+    dictproxy.handle_set = lambda addr, parts: True
+    lines = [
+        b"B1\tuser@example.org",
+        b"S1\tpriv/guid00/devicetoken\t0123456789abcdef",
+        b"S1\tpriv/guid00/messagenew",
+        b"C1",
+    ]
+
+    def transaction():
+        assert dictproxy.handle_lines(lines, {}) == (["O\n"], False)
+
+    ops_per_second(transaction, 100000, "dict transaction batch")
+
+
+def test_dictproto_unescape_long(ops_per_second):
+    s = '\\"' * 10000 + '"user@example.org'
+    ops_per_second(lambda: split_and_unescape(s), 100, "unescape 20k chars")
@@ -135,6 +135,39 @@ def test_config_tls_external_bad_format(make_config):
         )
 
 
+def test_config_dictproxy_engine(make_config):
+    config = make_config("chat.example.org")
+    assert config.dictproxy_engine == "threads"
+    assert config.dictproxy_workers == 16
+
+    config = make_config(
+        "chat.example.org", {"dictproxy_engine": "asyncio", "dictproxy_workers": "4"}
+    )
+    assert config.dictproxy_engine == "asyncio"
+    assert config.dictproxy_workers == 4
+
+    with pytest.raises(ValueError, match="dictproxy_engine"):
+        make_config("chat.example.org", {"dictproxy_engine": "fibers"})
+
+
+def test_config_doveauth_workers(make_config):
+    assert make_config("chat.example.org").doveauth_workers == 1
+    config = make_config("chat.example.org", {"doveauth_workers": "4"})
+    assert config.doveauth_workers == 4
+
+    with pytest.raises(ValueError, match="doveauth_workers"):
+        make_config("chat.example.org", {"doveauth_workers": "0"})
+
+
+def test_config_metadata_backend(make_config):
+    assert make_config("chat.example.org").metadata_backend == "maildir"
+    config = make_config("chat.example.org", {"metadata_backend": "sqlite"})
+    assert config.metadata_backend == "sqlite"
+
+    with pytest.raises(ValueError, match="metadata_backend"):
+        make_config("chat.example.org", {"metadata_backend": "redis"})
+
+
 def test_parse_size_mb():
     assert parse_size_mb("500M") == 500
     assert parse_size_mb("2G") == 2048
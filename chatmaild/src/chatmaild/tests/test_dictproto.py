@@ -0,0 +1,56 @@
+import pytest
+
+from chatmaild.dictproto import (
+    format_request,
+    parse_request,
+    reply_iter_item,
+    reply_ok,
+    split_and_unescape,
+)
+
+
+def test_parse_request():
+    assert parse_request(b"Lshared/userdb/a@b\ta@b\n") == (
+        "L",
+        ["shared/userdb/a@b", "a@b"],
+    )
+    assert parse_request("I0\t0\tshared/userdb/") == ("I", ["0", "0", "shared/userdb/"])
+    assert parse_request(b"C1") == ("C", ["1"])
+    assert parse_request(b"\n") == ("", [])
+    assert parse_request(b"") == ("", [])
+
+
+def test_format_request():
+    line = "S1\tpriv/guid/devicetoken\t0123"
+    assert format_request(*parse_request(line)) == line
+
+
+@pytest.mark.parametrize(
+    ["s", "parts"],
+    [
+        ("", [""]),
+        ("user@example.org", ["user@example.org"]),
+        ('pass"user@example.org', ["pass", "user@example.org"]),
+        ('a\\"b"c', ['a"b', "c"]),
+        ("a\\\\b", ["a\\b"]),
+        ('\\\'x\\\\"y"', ["'x\\", "y", ""]),
+    ],
+)
+def test_split_and_unescape(s, parts):
+    assert split_and_unescape(s) == parts
+
+
+def test_split_and_unescape_dangling_escape():
+    with pytest.raises(ValueError):
+        split_and_unescape('abc"def\\')
+
+
+def test_split_and_unescape_long_input():
+    s = '\\"' * 100000 + '"user@example.org'
+    assert split_and_unescape(s) == ['"' * 100000, "user@example.org"]
+
+
+def test_replies():
+    assert reply_ok("1000") == "O1000\n"
+    assert reply_ok("") == "O\n"
+    assert reply_iter_item("shared/userdb/a@b") == "Oshared/userdb/a@b\t\n"
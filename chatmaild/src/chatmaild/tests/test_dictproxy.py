@@ -0,0 +1,179 @@
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from chatmaild.dictproxy import DictProxy, get_listener
+
+
+class EchoDictProxy(DictProxy):
+    def handle_lookup(self, parts):
+        return f"O{parts[0]}\n"
+
+    def handle_set(self, addr, parts):
+        return parts[1].endswith("/ok")
+
+    def handle_iterate(self, parts):
+        return iter([f"O{parts[2]}/1\t\n", f"O{parts[2]}/2\t\n", "\n"])
+
+
+class MockWriter:
+    def __init__(self):
+        self.data = io.BytesIO()
+        self.closed = False
+
+    def write(self, data):
+        self.data.write(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def handle_connection(dictproxy, data):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        writer = MockWriter()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            await dictproxy.handle_connection(reader, writer, executor)
+        return writer
+
+    return asyncio.run(run())
+
+
+def test_async_lookups_keep_order():
+    data = b"H3\t2\t0\t\tauth\n" + b"".join(b"Lkey%d\tuser\n" % i for i in range(20))
+    writer = handle_connection(EchoDictProxy(), data)
+    assert writer.closed
+    assert writer.data.getvalue() == b"".join(b"Okey%d\n" % i for i in range(20))
+
+
+def test_async_transactions():
+    data = b"\n".join(
+        [
+            b"B1\tuser@example.org",
+            b"S1\tpriv/guid/ok\tvalue",
+            b"C1",
+            b"B2\tuser@example.org",
+            b"S2\tpriv/guid/bad\tvalue",
+            b"C2",
+        ]
+    )
+    writer = handle_connection(EchoDictProxy(), data)
+    assert writer.data.getvalue() == b"O\nF\n"
+
+
+def test_async_handler_exception_closes_connection(caplog):
+    class FailingDictProxy(DictProxy):
+        def handle_lookup(self, parts):
+            raise ValueError("broken")
+
+    writer = handle_connection(FailingDictProxy(), b"Lkey\tuser\nLkey\tuser\n")
+    assert writer.closed
+    assert writer.data.getvalue() == b""
+    assert "Exception in the handler" in caplog.text
+
+
+def test_async_engine_serves_socket(tmp_path):
+    socket_path = str(tmp_path.joinpath("dictproxy.socket"))
+
+    async def run():
+        listener = get_listener(socket_path)
+        server = asyncio.create_task(EchoDictProxy()._serve_async(listener, 2))
+        for _ in range(100):
+            if tmp_path.joinpath("dictproxy.socket").exists():
+                break
+            await asyncio.sleep(0.01)
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        writer.write(b"H\nLkey1\tuser\nLkey2\tuser\n")
+        replies = [await reader.readline() for _ in range(2)]
+        writer.close()
+        server.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await server
+        return replies
+
+    assert asyncio.run(run()) == [b"Okey1\n", b"Okey2\n"]
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_serve_forever_selects_engine(make_config, monkeypatch, tmp_path, engine):
+    config = make_config("chat.example.org", {"dictproxy_engine": engine})
+    dictproxy = DictProxy()
+    calls = []
+    monkeypatch.setattr(
+        dictproxy, "serve_forever_threaded", lambda listener: calls.append("threads")
+    )
+    monkeypatch.setattr(
+        dictproxy,
+        "serve_forever_async",
+        lambda listener, max_workers: calls.append("asyncio"),
+    )
+    dictproxy.serve_forever(str(tmp_path.joinpath("dictproxy.socket")), config)
+    assert calls == [engine]
+
+
+class FlushCountingWriter(io.BytesIO):
+    flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+
+class ChunkedReader:
+    """Reader returning input in fixed-size chunks like a socket would."""
+
+    def __init__(self, data, chunksize):
+        self.chunks = [data[i : i + chunksize] for i in range(0, len(data), chunksize)]
+
+    def read1(self, size):
+        return self.chunks.pop(0) if self.chunks else b""
+
+
+def test_pipelined_replies_are_flushed_once():
+    rfile = io.BytesIO(b"".join(b"Lkey%d\tuser\n" % i for i in range(50)))
+    wfile = FlushCountingWriter()
+    EchoDictProxy().loop_forever(rfile, wfile)
+    assert wfile.getvalue() == b"".join(b"Okey%d\n" % i for i in range(50))
+    assert wfile.flushes == 1
+
+
+def test_pipelined_transaction_reply_order():
+    rfile = io.BytesIO(
+        b"Lkey0\tuser\nB1\tuser@example.org\nS1\tpriv/guid/ok\tv\nC1\nLkey1\tuser\n"
+    )
+    wfile = FlushCountingWriter()
+    EchoDictProxy().loop_forever(rfile, wfile)
+    assert wfile.getvalue() == b"Okey0\nO\nOkey1\n"
+    assert wfile.flushes == 1
+
+
+@pytest.mark.parametrize("chunksize", [1, 3, 7, 64])
+def test_lines_split_across_reads(chunksize):
+    data = b"".join(b"Lkey%d\tuser\n" % i for i in range(10)) + b"Llast\tuser"
+    wfile = FlushCountingWriter()
+    EchoDictProxy().loop_forever(ChunkedReader(data, chunksize), wfile)
+    expected = b"".join(b"Okey%d\n" % i for i in range(10)) + b"Olast\n"
+    assert wfile.getvalue() == expected
+
+
+def test_empty_line_ends_connection():
+    rfile = io.BytesIO(b"Lkey0\tuser\n\nLkey1\tuser\n")
+    wfile = FlushCountingWriter()
+    EchoDictProxy().loop_forever(rfile, wfile)
+    assert wfile.getvalue() == b"Okey0\n"
+
+
+def test_streamed_iterate_replies():
+    data = b"Lkey0\tuser\nI1\t0\tprefix\nLkey1\tuser\n"
+    expected = b"Okey0\nOprefix/1\t\nOprefix/2\t\n\nOkey1\n"
+    wfile = FlushCountingWriter()
+    EchoDictProxy().loop_forever(io.BytesIO(data), wfile)
+    assert wfile.getvalue() == expected
+    assert wfile.flushes == 4
+    assert handle_connection(EchoDictProxy(), data).data.getvalue() == expected
@@ -1,9 +1,17 @@
 import io
 import json
+import os
 import queue
+import shutil
+import signal
+import socket
+import subprocess
+import sys
 import threading
+import time
 import traceback
 
+import psutil
 import pytest
 
 import chatmaild.doveauth
@@ -216,3 +224,308 @@ def test_insufficient_resources_block_creation_not_existing_logins(
     newaddr, newpassword = gencreds()
     assert not dictproxy.lookup_passdb(newaddr, newpassword)
     assert dictproxy.lookup_passdb(addr, password)
+
+
+def test_userdb_cache_hits_and_misses(dictproxy, gencreds):
+    addr, password = gencreds()
+    cache = dictproxy.userdb_cache
+    assert not dictproxy.lookup_userdb(addr)
+    created = dictproxy.lookup_passdb(addr, password)
+    misses = cache.misses
+    for _ in range(3):
+        assert dictproxy.lookup_userdb(addr) == created
+    assert cache.hits == 3
+    assert cache.misses == misses
+
+
+def test_userdb_cache_revalidates_changed_password(dictproxy, gencreds):
+    addr, password = gencreds()
+    dictproxy.lookup_passdb(addr, password)
+    assert dictproxy.lookup_userdb(addr)
+    user = dictproxy.config.get_user(addr)
+    user.set_password("{SHA512-CRYPT}changed")
+    assert dictproxy.lookup_userdb(addr)["password"] == "{SHA512-CRYPT}changed"
+
+
+def test_userdb_cache_notices_removed_mailbox(dictproxy, gencreds):
+    addr, password = gencreds()
+    dictproxy.lookup_passdb(addr, password)
+    assert dictproxy.lookup_userdb(addr)
+    shutil.rmtree(dictproxy.config.get_user(addr).maildir)
+    assert not dictproxy.lookup_userdb(addr)
+    assert addr not in dictproxy.userdb_cache.entries
+
+
+def test_userdb_cache_is_bounded(make_config, gencreds):
+    config = make_config("chat.example.org", {"userdb_cache_size": "3"})
+    dictproxy = AuthDictProxy(config=config)
+    addresses = []
+    for _ in range(5):
+        addr, password = gencreds()
+        dictproxy.lookup_passdb(addr, password)
+        addresses.append(addr)
+    assert list(dictproxy.userdb_cache.entries) == addresses[-3:]
+
+
+def test_userdb_cache_disabled(make_config, gencreds):
+    config = make_config("chat.example.org", {"userdb_cache_size": "0"})
+    dictproxy = AuthDictProxy(config=config)
+    addr, password = gencreds()
+    assert dictproxy.lookup_passdb(addr, password)
+    assert dictproxy.lookup_userdb(addr)
+    assert not dictproxy.userdb_cache.entries
+    assert dictproxy.userdb_cache.hits == 0
+
+
+def test_verify_password():
+    enc_password = chatmaild.doveauth.encrypt_password("zequ0Aimuchoodaechik")
+    assert chatmaild.doveauth.verify_password("zequ0Aimuchoodaechik", enc_password)
+    assert not chatmaild.doveauth.verify_password("wrong", enc_password)
+    assert not chatmaild.doveauth.verify_password("zequ0Aimuchoodaechik", "plain")
+
+
+@pytest.fixture
+def cached_dictproxy(make_config):
+    config = make_config("chat.example.org", {"password_cache_ttl": "60"})
+    return AuthDictProxy(config=config)
+
+
+def test_password_cache_disabled_by_default(dictproxy):
+    assert dictproxy.verified_passwords is None
+
+
+def test_password_cache_login(cached_dictproxy, gencreds, monkeypatch):
+    def fail_verify(password, enc_password):
+        raise AssertionError("password was hashed again")
+
+    monkeypatch.setattr(chatmaild.doveauth, "verify_password", fail_verify)
+    addr, password = gencreds()
+    # the hash computed for creation is not checked again
+    created = cached_dictproxy.lookup_passdb(addr, password)
+    assert created["nopassword"] == "Y" and "password" not in created
+    res = cached_dictproxy.lookup_passdb(addr, password)
+    assert res == created
+    assert res["home"].endswith(addr)
+
+
+def test_password_cache_wrong_password(cached_dictproxy, gencreds, monkeypatch):
+    addr, password = gencreds()
+    cached_dictproxy.lookup_passdb(addr, password)
+    calls = []
+    orig = chatmaild.doveauth.verify_password
+    monkeypatch.setattr(
+        chatmaild.doveauth,
+        "verify_password",
+        lambda *args: calls.append(args) or orig(*args),
+    )
+    # the login is rejected without a password hash for dovecot to check again
+    assert cached_dictproxy.lookup_passdb(addr, "wrongpassword") is None
+    assert len(calls) == 1
+    res = cached_dictproxy.handle_lookup([f'shared/passdb/wrongpassword"{addr}'])
+    assert res == "N\n"
+    assert len(calls) == 2
+
+
+def test_password_cache_stores_no_passwords(cached_dictproxy, gencreds):
+    addr, password = gencreds()
+    cached_dictproxy.lookup_passdb(addr, password)
+    digest, enc_password, expires = cached_dictproxy.verified_passwords.entries[addr]
+    assert password.encode() not in digest
+    assert password not in enc_password
+
+
+def test_password_cache_changed_password(cached_dictproxy, gencreds):
+    addr, password = gencreds()
+    cached_dictproxy.lookup_passdb(addr, password)
+    user = cached_dictproxy.config.get_user(addr)
+    user.set_password(chatmaild.doveauth.encrypt_password("anotherpassword"))
+    assert cached_dictproxy.lookup_passdb(addr, password) is None
+    assert cached_dictproxy.lookup_passdb(addr, "anotherpassword")["nopassword"]
+
+
+def test_password_cache_expires(cached_dictproxy, gencreds, monkeypatch):
+    addr, password = gencreds()
+    cached_dictproxy.lookup_passdb(addr, password)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    calls = []
+    orig = chatmaild.doveauth.verify_password
+    monkeypatch.setattr(
+        chatmaild.doveauth,
+        "verify_password",
+        lambda *args: calls.append(args) or orig(*args),
+    )
+    assert cached_dictproxy.lookup_passdb(addr, password)["nopassword"]
+    assert len(calls) == 1
+
+
+def test_password_hash_workers(make_config, gencreds):
+    config = make_config("chat.example.org", {"password_hash_workers": "2"})
+    dictproxy = AuthDictProxy(config=config)
+    addr, password = gencreds()
+    try:
+        userdata = dictproxy.lookup_passdb(addr, password)
+        assert chatmaild.doveauth.verify_password(password, userdata["password"])
+        assert dictproxy.password_hasher.executor is not None
+    finally:
+        dictproxy.password_hasher.executor.shutdown()
+
+
+def test_password_hash_worker_dies(make_config, gencreds, caplog):
+    config = make_config("chat.example.org", {"password_hash_workers": "1"})
+    dictproxy = AuthDictProxy(config=config)
+    hasher = dictproxy.password_hasher
+    try:
+        assert dictproxy.lookup_passdb(*gencreds())
+        broken = hasher.executor
+        for process in list(broken._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+
+        addr, password = gencreds()
+        userdata = dictproxy.lookup_passdb(addr, password)
+        assert chatmaild.doveauth.verify_password(password, userdata["password"])
+        assert hasher.executor is not broken
+        assert "starting a new one" in caplog.text
+    finally:
+        hasher.executor.shutdown()
+
+
+def test_password_hash_queue_full_rejects_creation(make_config, gencreds, caplog):
+    config = make_config(
+        "chat.example.org",
+        {"password_hash_workers": "1", "password_hash_queue_size": "1"},
+    )
+    dictproxy = AuthDictProxy(config=config)
+    hasher = dictproxy.password_hasher
+    hasher.TIMEOUT = 0.01
+    addr, password = gencreds()
+    assert hasher.slots.acquire()
+    assert not dictproxy.lookup_passdb(addr, password)
+    assert "queue is full" in caplog.text
+    assert not dictproxy.lookup_userdb(addr)
+    assert hasher.executor is None
+
+
+def test_iterate_streams_chunks(dictproxy, monkeypatch):
+    monkeypatch.setattr(chatmaild.doveauth, "ITERATE_CHUNK_SIZE", 3)
+    for i in range(7):
+        dictproxy.lookup_passdb(f"asdf1234{i}@chat.example.org", "q9mr3faue")
+
+    chunks = list(dictproxy.handle_iterate(["0", "0", "shared/userdb/"]))
+    assert [chunk.count("\t\n") for chunk in chunks] == [3, 3, 1]
+    assert chunks[-1].endswith("\t\n\n")
+
+    rfile = io.BytesIO(b"I0\t0\tshared/userdb/\n")
+    wfile = io.BytesIO()
+    dictproxy.loop_forever(rfile, wfile)
+    assert wfile.getvalue().decode("ascii") == "".join(chunks)
+
+
+def test_iterate_snapshot(make_config, monkeypatch):
+    config = make_config("chat.example.org", {"userdb_iterate_snapshot": "true"})
+    dictproxy = AuthDictProxy(config=config)
+    for i in range(3):
+        dictproxy.lookup_passdb(f"asdf1234{i}@chat.example.org", "q9mr3faue")
+    mailboxes_dir = config.mailboxes_dir
+    old = time.time() - 10
+    os.utime(mailboxes_dir, (old, old))
+
+    scans = []
+    orig_scan_addresses = chatmaild.doveauth.scan_addresses
+    monkeypatch.setattr(
+        chatmaild.doveauth,
+        "scan_addresses",
+        lambda path: scans.append(path) or orig_scan_addresses(path),
+    )
+    first = list(dictproxy.iter_userdb())
+    assert list(dictproxy.iter_userdb()) == first
+    assert len(first) == 3
+    assert len(scans) == 1
+
+    # adding an address changes the directory mtime and refreshes the snapshot
+    dictproxy.lookup_passdb("asdf12349@chat.example.org", "q9mr3faue")
+    assert len(list(dictproxy.iter_userdb())) == 4
+    assert len(scans) == 2
+
+
+def test_iterate_snapshot_not_kept_for_recent_changes(make_config):
+    config = make_config("chat.example.org", {"userdb_iterate_snapshot": "true"})
+    dictproxy = AuthDictProxy(config=config)
+    dictproxy.lookup_passdb("asdf12340@chat.example.org", "q9mr3faue")
+    assert list(dictproxy.iter_userdb()) == ["asdf12340@chat.example.org"]
+    assert dictproxy.userdb_snapshot is None
+
+
+def test_creation_leaves_no_lock_files(dictproxy, gencreds):
+    addr, password = gencreds()
+    dictproxy.lookup_passdb(addr, password)
+    maildir = dictproxy.config.get_user(addr).maildir
+    assert sorted(p.name for p in maildir.iterdir()) == [
+        "enforceE2EEincoming",
+        "password",
+    ]
+
+
+def test_concurrent_creation_shared_locks(example_config):
+    dictproxy = AuthDictProxy(config=example_config, shared_locks=True)
+    addr = "racetest2@chat.example.org"
+    results = queue.Queue()
+
+    def create():
+        results.put(dictproxy.lookup_passdb(addr, "zequ0Aimuchoodaechik"))
+
+    threads = [threading.Thread(target=create, daemon=True) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=10)
+
+    passwords_seen = {results.get()["password"] for _ in threads}
+    assert len(passwords_seen) == 1
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def lookup_over_socket(socket_path, addr, password):
+    key = f'shared/passdb/{password}"{addr}'
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(socket_path)
+        sock.sendall(f"H3\t2\t0\t\tauth\nL{key}\t{addr}\n".encode())
+        return sock.makefile("rb").readline()
+
+
+def test_prefork_workers_are_restarted(make_config, gencreds, tmp_path):
+    config = make_config("chat.example.org", {"doveauth_workers": "2"})
+    socket_path = str(tmp_path.joinpath("doveauth.socket"))
+    args = [socket_path, str(config._inipath)]
+    code = "from chatmaild.doveauth import main; main()"
+    proc = subprocess.Popen([sys.executable, "-c", code, *args])
+    try:
+        supervisor = psutil.Process(proc.pid)
+        wait_for(lambda: len(supervisor.children()) == 2)
+        wait_for(lambda: os.path.exists(socket_path))
+
+        addr, password = gencreds()
+        assert lookup_over_socket(socket_path, addr, password).startswith(b"O{")
+
+        crashed = supervisor.children()[0]
+        crashed.kill()
+        wait_for(lambda: crashed.pid not in [c.pid for c in supervisor.children()])
+        wait_for(lambda: len(supervisor.children()) == 2)
+        for _ in range(4):
+            assert lookup_over_socket(socket_path, addr, password).startswith(b"O{")
+
+        workers = supervisor.children()
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=10) == 0
+        psutil.wait_procs(workers, timeout=10)
+        assert not any(worker.is_running() for worker in workers)
+    finally:
+        proc.kill()
+        proc.wait()
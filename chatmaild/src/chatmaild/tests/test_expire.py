@@ -1,4 +1,5 @@
 import itertools
+import json
 import os
 import random
 import shutil
@@ -9,11 +10,13 @@ from pathlib import Path
 
 import pytest
 
+import chatmaild.expire
 from chatmaild.expire import (
     Expiry,
     FileEntry,
     MailboxStat,
     expire_to_target,
+    get_expire_index,
     get_file_entry,
     iter_mailboxes,
     os_listdir_if_exists,
@@ -23,6 +26,7 @@ from chatmaild.expire import (
 )
 from chatmaild.expire import daily_expire_main as expiry_main
 from chatmaild.fsreport import main as report_main
+from chatmaild.metadata import Metadata, open_metadata
 
 MB = 1024 * 1024
 
@@ -51,6 +55,14 @@ def create_new_messages(basedir, relpaths, size=1000, days=0):
         os.utime(msg_path, (now, now - days * 86400))
 
 
+def backdate_dirs(basedir, seconds=10):
+    """Move the directory mtimes of a mailbox out of the racy window."""
+    mtime = time.time() - seconds
+    for path in [Path(basedir), *Path(basedir).rglob("*")]:
+        if path.is_dir():
+            os.utime(path, (mtime, mtime))
+
+
 @pytest.fixture
 def mbox1(example_config):
     mboxdir = example_config.mailboxes_dir.joinpath("mailbox1@example.org")
@@ -132,6 +144,118 @@ def test_mbox_without_password(mbox1, example_config, capsys):
     assert not os.path.isdir(mbox_rescan.basedir)
 
 
+@pytest.mark.parametrize("workers", [1, 3])
+def test_iter_mailboxes_workers(example_config, workers):
+    basedir = example_config.mailboxes_dir
+    for i in range(20):
+        mboxdir = basedir.joinpath(f"mailbox{i}@example.org")
+        mboxdir.mkdir()
+        fill_mbox(mboxdir)
+    basedir.joinpath("not-a-mailbox").mkdir()
+    serial = list(iter_mailboxes(str(basedir), maxnum=None))
+    mailboxes = list(iter_mailboxes(str(basedir), maxnum=None, workers=workers))
+    assert len(mailboxes) == 20
+    assert [m.basedir for m in mailboxes] == [m.basedir for m in serial]
+    for mbox, expected in zip(mailboxes, serial):
+        assert sorted(mbox.messages) == sorted(expected.messages)
+        assert mbox.extrafiles == expected.extrafiles
+        assert mbox.last_login == expected.last_login
+
+
+def test_mailbox_stat_skips_non_regular_files(tmp_path):
+    fill_mbox(tmp_path)
+    # a file named like a maildir folder is an extra file
+    tmp_path.joinpath("tmp").write_text("xyz")
+    os.symlink(tmp_path.joinpath("vanished"), tmp_path.joinpath("cur", "dangling"))
+    mbox = MailboxStat(tmp_path)
+    assert len(mbox.messages) == 2
+    assert f"{tmp_path}/tmp" in [entry.path for entry in mbox.extrafiles]
+
+
+def test_mailbox_stat_columns(mbox1):
+    assert list(mbox1.message_sizes) == [m.size for m in mbox1.messages]
+    assert sorted(mbox1.message_sizes) == [500, 600]
+    folders = [mbox1.folders[i] for i in mbox1.message_folders]
+    assert sorted(os.path.basename(folder) for folder in folders) == ["cur", "new"]
+    assert sorted(m.path for m in mbox1.messages) == [
+        f"{mbox1.basedir}/cur/msg1",
+        f"{mbox1.basedir}/new/msg2",
+    ]
+
+
+def test_mailbox_stat_keeps_selected_names(mbox1):
+    selected = []
+
+    def select(folder, mtime, size):
+        selected.append(os.path.basename(folder))
+        return size == 600
+
+    mbox = MailboxStat(mbox1.basedir, select=select)
+    assert sorted(selected) == ["cur", "new"]
+    assert len(mbox.message_names) == 1
+    assert [m.path for m in mbox.iter_messages(selected_only=True)] == [
+        f"{mbox1.basedir}/new/msg2"
+    ]
+    assert sorted(m.path or "" for m in mbox.messages) == [
+        "",
+        mbox.basedir + "/new/msg2",
+    ]
+
+
+def test_expiry_select_keeps_only_expired_names(example_config, mbox1):
+    now = datetime.utcnow().timestamp()
+    days = int(example_config.delete_mails_after) + 1
+    create_new_messages(mbox1.basedir, ["cur/old"], days=days)
+    exp = Expiry(example_config, dry=True, now=now, verbose=False)
+    mbox = MailboxStat(mbox1.basedir, select=exp.is_expired)
+    assert list(mbox.message_names.values()) == ["old"]
+    exp.process_mailbox_stat(mbox)
+    assert exp.all_files == 3
+    assert exp.del_files == 2  # the old message and maildirsize
+
+
+def test_mailbox_stat_filename_only(tmp_path, monkeypatch):
+    fill_mbox(tmp_path)
+    path = _create_message(tmp_path, "cur", 3000, days_old=30, disk_size=100)
+    stat_calls = []
+    get_dir_entry = chatmaild.expire.get_dir_entry
+    monkeypatch.setattr(
+        chatmaild.expire,
+        "get_dir_entry",
+        lambda entry: stat_calls.append(entry.name) or get_dir_entry(entry),
+    )
+    mbox = MailboxStat(tmp_path, filename_only=True)
+    entries = {entry.path: entry for entry in mbox.messages}
+    assert len(entries) == 3
+    entry = entries[str(path)]
+    assert entry.size == 3000
+    assert entry.mtime == int(path.stat().st_mtime)
+    # names without Dovecot fields are stat-ed
+    assert "msg1" in stat_calls and "msg2" in stat_calls
+    assert path.name not in stat_calls
+
+    stat_calls.clear()
+    mbox = MailboxStat(tmp_path)
+    assert path.name in stat_calls
+    assert {entry.path: entry.size for entry in mbox.messages}[str(path)] == 100
+
+
+def test_expiry_cli_filename_only(capsys, make_config):
+    config = make_config("chat.example.org", {"expire_filename_only": "true"})
+    assert config.expire_filename_only
+    mboxdir = config.mailboxes_dir.joinpath("mailbox1@example.org")
+    mboxdir.mkdir()
+    fill_mbox(mboxdir)
+    days_old = int(config.delete_mails_after) + 1
+    old = _create_message(mboxdir, "cur", 1000, days_old=days_old)
+    # the time in the filename decides, not the mtime
+    os.utime(old, None)
+    fresh = _create_message(mboxdir, "cur", 1000, days_old=1)
+    expiry_main([str(config._inipath), "--remove"])
+    assert not old.exists()
+    assert fresh.exists()
+
+
 def test_report_no_mailboxes(example_config):
     args = (str(example_config._inipath),)
     report_main(args)
@@ -219,6 +343,103 @@ def test_expiry_cli_old_files(capsys, example_config, mbox1):
     assert "shouldstay" not in err
 
 
+def test_expiry_skips_unchanged_mailboxes(capsys, example_config, mbox1):
+    args = str(example_config._inipath), "--remove"
+    backdate_dirs(mbox1.basedir)
+    mtime = example_config.mailboxes_dir.stat().st_mtime_ns
+    expiry_main(args)
+    assert "(0 unchanged mailboxes skipped)" in capsys.readouterr().out
+    index = get_expire_index(example_config.mailboxes_dir).path
+    assert "mailbox1@example.org" in json.loads(index.read_text())
+    # the index does not change the mailbox list
+    assert example_config.mailboxes_dir.stat().st_mtime_ns == mtime
+    expiry_main(args)
+    assert "(1 unchanged mailboxes skipped)" in capsys.readouterr().out
+
+    # a delivery changes the mailbox
+    create_new_messages(mbox1.basedir, ["new/msg3"])
+    expiry_main(args)
+    assert "(0 unchanged mailboxes skipped)" in capsys.readouterr().out
+    # a just changed mailbox is not recorded as unchanged
+    assert "mailbox1@example.org" not in json.loads(index.read_text())
+    expiry_main(args)
+    assert "(0 unchanged mailboxes skipped)" in capsys.readouterr().out
+    backdate_dirs(mbox1.basedir)
+    expiry_main(args)
+    assert "(0 unchanged mailboxes skipped)" in capsys.readouterr().out
+    expiry_main(args)
+    assert "(1 unchanged mailboxes skipped)" in capsys.readouterr().out
+    expiry_main(list(args) + ["--full"])
+    assert "(0 unchanged mailboxes skipped)" in capsys.readouterr().out
+
+
+def test_expiry_does_not_skip_expiring_mailboxes(example_config, mbox1):
+    backdate_dirs(mbox1.basedir)
+    expiry_main([str(example_config._inipath), "--remove"])
+    mboxdir = mbox1.basedir
+
+    def can_skip(days=0):
+        now = time.time() + days * 86400
+        exp = Expiry(example_config, False, now, False, incremental=True)
+        return exp.can_skip(mboxdir)
+
+    assert can_skip()
+    assert not can_skip(days=int(example_config.delete_mails_after) + 1)
+    assert not can_skip(days=example_config.delete_inactive_users_after + 1)
+    create_new_messages(mboxdir, ["cur/large"], size=300000)
+    backdate_dirs(mboxdir)
+    expiry_main([str(example_config._inipath), "--remove"])
+    assert can_skip()
+    assert not can_skip(days=int(example_config.delete_large_after) + 1)
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_expiry_cli_writes_report(capsys, example_config, mbox1, tmp_path, legacy):
+    args = [str(example_config._inipath), "--remove"]
+    expiry_main(args)
+    capsys.readouterr()
+    args += ["--textfile", str(tmp_path)]
+    if legacy:
+        args += ["--legacy-metrics", str(tmp_path.joinpath("metrics"))]
+    expiry_main(args)
+    # the report needs all mailboxes, so none are skipped
+    assert "(0 unchanged mailboxes skipped)" in capsys.readouterr().out
+    textfile = tmp_path.joinpath("fsreport.prom").read_text()
+    assert 'chatmail_storage_bytes{kind="messages"} 1100' in textfile
+    assert 'chatmail_accounts{kind="all"} 1' in textfile
+    assert tmp_path.joinpath("metrics").exists() == legacy
+
+    report_path = tmp_path.joinpath("fsreport-only.prom")
+    report_main([str(example_config._inipath), "--textfile", str(report_path)])
+    assert report_path.read_text() == textfile
+
+
+def test_expiry_rechecks_quota(example_config):
+    mboxdir = example_config.mailboxes_dir.joinpath("user@example.org")
+    mboxdir.mkdir()
+    fill_mbox(mboxdir)
+    _create_message(mboxdir, "cur", 2 * MB, days_old=5)
+    backdate_dirs(mboxdir)
+    expiry_main([str(example_config._inipath), "--remove"])
+    index = get_expire_index(example_config.mailboxes_dir).path
+    summaries = json.loads(index.read_text())
+
+    def can_skip():
+        exp = Expiry(example_config, False, time.time(), False, incremental=True)
+        return exp.can_skip(str(mboxdir))
+
+    assert can_skip()
+    # a lowered max_mailbox_size may require removing messages
+    example_config.max_mailbox_size = "1M"
+    assert not can_skip()
+    example_config.max_mailbox_size = "500M"
+
+    # quota expiry leaves the index alone, the changed mtimes cause a rescan
+    quota_expire_main([str(1), str(mboxdir)])
+    assert json.loads(index.read_text()) == summaries
+    assert not can_skip()
+
+
 def test_get_file_entry(tmp_path):
     assert get_file_entry(str(tmp_path.joinpath("123123"))) is None
     p = tmp_path.joinpath("x")
@@ -280,3 +501,59 @@ def test_quota_expire_main(tmp_path, capsys):
     _, err = capsys.readouterr()
     assert "quota-expire: removed 1 message(s) from user@example.org" in err
     assert not (mbox / "maildirsize").exists()
+
+
+def test_expiry_removes_stale_password_lock(capsys, example_config, mbox1):
+    lock_path = Path(mbox1.basedir).joinpath("password.lock")
+    lock_path.touch()
+    args = str(example_config._inipath), "--remove", "-v"
+    expiry_main(args)
+    assert not lock_path.exists()
+    assert Path(mbox1.basedir).joinpath("password").exists()
+
+
+@pytest.mark.parametrize("backend", ["maildir", "sqlite"])
+def test_expiry_sweeps_device_tokens(capsys, make_config, backend):
+    config = make_config("chat.example.org", {"metadata_backend": backend})
+    now = int(time.time())
+    metadata = open_metadata(config)
+    for name in ("mailbox1@example.org", "mailbox2@example.org"):
+        config.mailboxes_dir.joinpath(name).mkdir()
+        fill_mbox(config.mailboxes_dir.joinpath(name))
+        metadata.add_token_to_addr(name, "fresh")
+    with metadata._modify_tokens("mailbox1@example.org") as tokens:
+        tokens["old1"] = tokens["old2"] = now - 91 * 86400
+
+    expiry_main((str(config._inipath),))
+    out, err = capsys.readouterr()
+    assert "and 2 expired device tokens of 1 addresses" in out
+    assert len(open_metadata(config).get_tokens_for_addr("mailbox1@example.org")) == 1
+
+    expiry_main((str(config._inipath), "--remove"))
+    out, err = capsys.readouterr()
+    assert "and 2 expired device tokens of 1 addresses" in out
+    expiry_main((str(config._inipath), "--remove"))
+    out, err = capsys.readouterr()
+    assert "and 0 expired device tokens of 0 addresses" in out
+    for name in ("mailbox1@example.org", "mailbox2@example.org"):
+        assert metadata.get_tokens_for_addr(name) == ["fresh"]
+
+
+def test_expiry_sqlite_ignores_leftover_metadata_files(capsys, make_config):
+    config = make_config("chat.example.org", {"metadata_backend": "sqlite"})
+    now = int(time.time())
+    name = "mailbox1@example.org"
+    config.mailboxes_dir.joinpath(name).mkdir()
+    fill_mbox(config.mailboxes_dir.joinpath(name))
+    # a metadata.json that was not yet migrated into the database
+    with Metadata(config.mailboxes_dir)._modify_tokens(name) as tokens:
+        tokens["legacy"] = now - 91 * 86400
+    metadata = open_metadata(config)
+    with metadata._modify_tokens(name) as tokens:
+        tokens["old"] = now - 91 * 86400
+
+    expiry_main((str(config._inipath), "--remove"))
+    out, err = capsys.readouterr()
+    # only the database sweep counts tokens
+    assert "and 1 expired device tokens of 1 addresses" in out
+    assert config.mailboxes_dir.joinpath(name, "metadata.json").exists()
@@ -1,5 +1,8 @@
+import os
 import threading
 
+import pytest
+
 from chatmaild.filedict import FileDict, write_bytes_atomic
 
 
@@ -37,3 +40,60 @@ def test_write_bytes_atomic_concurrent(tmp_path):
 
     assert p.read_text().strip() != "hello"
     assert len(list(p.parent.iterdir())) == 1
+
+
+@pytest.mark.parametrize(
+    "durability, syncs", [("none", []), ("file", ["file"]), ("dir", ["file", "dir"])]
+)
+def test_durability_modes(tmp_path, monkeypatch, durability, syncs):
+    calls = []
+    monkeypatch.setattr(os, "fdatasync", lambda fd: calls.append("file"))
+    monkeypatch.setattr(os, "fsync", lambda fd: calls.append("dir"))
+    fdict = FileDict(tmp_path.joinpath("metadata"), durability=durability)
+    with fdict.modify() as d:
+        d["key"] = "value"
+    assert calls == syncs
+    assert fdict.read() == {"key": "value"}
+
+
+def test_invalid_durability_mode(tmp_path):
+    with pytest.raises(ValueError):
+        FileDict(tmp_path.joinpath("metadata"), durability="always")
+
+
+def test_read_cache(tmp_path, monkeypatch):
+    fdict = FileDict(tmp_path.joinpath("metadata"), cache=True)
+    assert fdict.read() == {}
+    with fdict.modify() as d:
+        d["key"] = 1
+
+    parsed = []
+    parse = fdict._parse
+    monkeypatch.setattr(fdict, "_parse", lambda raw: parsed.append(raw) or parse(raw))
+    assert fdict.read() == {"key": 1}
+    assert fdict.read() is fdict.read()
+    assert len(parsed) == 1
+
+    # a write through another instance is noticed
+    with FileDict(fdict.path).modify() as d:
+        d["key"] = 2
+    assert fdict.read() == {"key": 2}
+    assert len(parsed) == 2
+
+
+def test_compare_and_swap(tmp_path):
+    fdict = FileDict(tmp_path.joinpath("metadata"), cache=True)
+    data, version = fdict.read_versioned()
+    assert (data, version) == ({}, None)
+    version = fdict.compare_and_swap(version, {"key": 1})
+    assert version == fdict.version()
+    assert fdict.read_versioned() == ({"key": 1}, version)
+
+    with FileDict(fdict.path).modify() as d:
+        d["key"] = 2
+    # the file was changed by another writer since version
+    assert fdict.compare_and_swap(version, {"key": 3}) is None
+    data, version = fdict.read_versioned()
+    assert data == {"key": 2}
+    assert fdict.compare_and_swap(version, {"key": 3})
+    assert FileDict(fdict.path).read() == {"key": 3}
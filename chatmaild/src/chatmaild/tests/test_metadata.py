@@ -1,19 +1,31 @@
+import asyncio
 import io
 import json
+import logging
+import os
+import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
 
 import pytest
 import requests
 
+from chatmaild.filedict import FileDict
 from chatmaild.metadata import (
     Metadata,
     MetadataDictProxy,
+    SqliteMetadata,
     read_appversions,
 )
 from chatmaild.notifier import (
+    CircuitBreaker,
+    HTTP2Session,
     Notifier,
     NotifyThread,
-    PersistentQueueItem,
+    QueueJournal,
+    Scheduler,
 )
 
 
@@ -46,6 +58,13 @@ def token():
     return "01234"
 
 
+def write_queue_file(queue_dir, addr, start_ts, token):
+    """Write a queue item file as stored by earlier versions."""
+    path = queue_dir.joinpath(uuid4().hex)
+    path.write_text(f"{addr}\n{int(start_ts)}\n{token}")
+    return path
+
+
 def get_mocked_requests(statuslist):
     class ReqMock:
         requests = []
@@ -127,11 +146,11 @@ def test_handle_dovecot_request_happy_path(dictproxy, testaddr, token):
     assert dictproxy.handle_dovecot_request(f"B{tx2}\t{testaddr}", transactions) is None
     msg = f"S{tx2}\tpriv/guid00/messagenew"
     assert dictproxy.handle_dovecot_request(msg, transactions) is None
-    queue_item = notifier.retry_queues[0].get()[1]
-    assert queue_item.token == token
+    retry_num, queue_item = notifier.scheduler.get(timeout=0)[1]
+    assert retry_num == 0 and queue_item.token == token
     assert dictproxy.handle_dovecot_request(f"C{tx2}", transactions) == "O\n"
     assert not transactions
-    assert queue_item.path.exists()
+    assert notifier.journal.pending[queue_item.queue_id] == queue_item
 
 
 def test_handle_dovecot_protocol_set_devicetoken(dictproxy):
@@ -193,12 +212,12 @@ def test_notifier_thread_deletes_persistent_file(metadata, notifier, testaddr):
     reqmock = get_mocked_requests([200])
     metadata.add_token_to_addr(testaddr, "01234")
     notifier.new_message_for_addr(testaddr, metadata)
-    NotifyThread(notifier, 0, None).retry_one(reqmock)
+    assert NotifyThread(notifier, None).retry_one(reqmock, timeout=0)
     url, data, timeout = reqmock.requests[0]
     assert data == "01234"
     assert metadata.get_tokens_for_addr(testaddr) == ["01234"]
     notifier.requeue_persistent_queue_items()
-    assert notifier.retry_queues[0].qsize() == 0
+    assert notifier.scheduler.qsize() == 0
 
 
 @pytest.mark.parametrize("status", [requests.exceptions.RequestException(), 404, 500])
@@ -208,25 +227,28 @@ def test_notifier_thread_connection_failures(
     """test that tokens keep getting retried until they are given up."""
     metadata.add_token_to_addr(testaddr, "01234")
     notifier.new_message_for_addr(testaddr, metadata)
-    notifier.NOTIFICATION_RETRY_DELAY = 5
-    max_tries = len(notifier.retry_queues)
-    for i in range(max_tries):
+    # keep the circuit closed to test the retries of a single item
+    notifier.breaker.FAILURE_THRESHOLD = notifier.max_tries + 1
+    last_when = notifier.scheduler.next_due()
+    for i in range(notifier.max_tries):
         caplog.clear()
         reqmock = get_mocked_requests([status])
-        sleep_calls = []
-        NotifyThread(notifier, i, None).retry_one(reqmock, sleep=sleep_calls.append)
-        assert notifier.retry_queues[i].qsize() == 0
+        # let time pass until the retry is due
+        when = notifier.scheduler.next_due()
+        assert when - last_when == notifier.compute_delay(i)
+        last_when = when
+        notifier.scheduler.clock = lambda: when
+        assert NotifyThread(notifier, None).retry_one(reqmock, timeout=0)
         assert "request failed" in caplog.records[0].msg
-        if i > 0:
-            assert len(sleep_calls) == 1
-        if i + 1 < max_tries:
-            assert notifier.retry_queues[i + 1].qsize() == 1
+        if i + 1 < notifier.max_tries:
+            assert notifier.scheduler.entries()[0][0] == i + 1
             assert len(caplog.records) == 1
         else:
+            assert notifier.scheduler.qsize() == 0
             assert len(caplog.records) == 2
             assert "deadline" in caplog.records[1].msg
     notifier.requeue_persistent_queue_items()
-    assert notifier.retry_queues[0].qsize() == 0
+    assert notifier.scheduler.qsize() == 0
 
 
 def test_requeue_removes_tmp_files(notifier, metadata, testaddr, caplog):
@@ -238,8 +260,8 @@ def test_requeue_removes_tmp_files(notifier, metadata, testaddr, caplog):
     notifier2.requeue_persistent_queue_items()
     assert "spurious" in caplog.records[0].msg
     assert not p.exists()
-    assert notifier2.retry_queues[0].qsize() == 1
-    when, queue_item = notifier2.retry_queues[0].get()
+    assert notifier2.scheduler.qsize() == 1
+    when, (retry_num, queue_item) = notifier2.scheduler.get(timeout=0)
     assert when <= int(time.time())
     assert queue_item.addr == testaddr
 
@@ -254,18 +276,17 @@ def test_requeue_removes_invalid_files(notifier, metadata, testaddr, caplog):
     notifier2.requeue_persistent_queue_items()
     assert "spurious" in caplog.records[0].msg
     assert not p.exists()
-    assert notifier2.retry_queues[0].qsize() == 1
-    when, queue_item = notifier2.retry_queues[0].get()
+    assert notifier2.scheduler.qsize() == 1
+    when, (retry_num, queue_item) = notifier2.scheduler.get(timeout=0)
     assert when <= int(time.time())
     assert queue_item.addr == testaddr
 
 
 def test_start_and_stop_notification_threads(notifier, testaddr):
     threads = notifier.start_notification_threads(None)
-    for retry_num, threadlist in threads.items():
-        for t in threadlist:
-            t.stop()
-            t.join()
+    assert len(threads) == notifier.MIN_WORKERS
+    notifier.stop_notification_threads()
+    assert not any(t.is_alive() for t in threads)
 
 
 def test_multi_device_notifier(metadata, notifier, testaddr):
@@ -273,10 +294,9 @@ def test_multi_device_notifier(metadata, notifier, testaddr):
     metadata.add_token_to_addr(testaddr, "56789")
     notifier.new_message_for_addr(testaddr, metadata)
     reqmock = get_mocked_requests([200, 200])
-    NotifyThread(notifier, 0, None).retry_one(reqmock)
-    NotifyThread(notifier, 0, None).retry_one(reqmock)
-    assert notifier.retry_queues[0].qsize() == 0
-    assert notifier.retry_queues[1].qsize() == 0
+    NotifyThread(notifier, None).retry_one(reqmock, timeout=0)
+    NotifyThread(notifier, None).retry_one(reqmock, timeout=0)
+    assert notifier.scheduler.qsize() == 0
     url, data, timeout = reqmock.requests[0]
     assert data == "01234"
     url, data, timeout = reqmock.requests[1]
@@ -290,32 +310,76 @@ def test_notifier_thread_run_gone_removes_token(metadata, notifier, testaddr):
     notifier.new_message_for_addr(testaddr, metadata)
 
     reqmock = get_mocked_requests([410, 200])
-    NotifyThread(notifier, 0, metadata.remove_token_from_addr).retry_one(reqmock)
-    NotifyThread(notifier, 0, None).retry_one(reqmock)
+    thread = NotifyThread(notifier, metadata.remove_token_from_addr)
+    thread.retry_one(reqmock, timeout=0)
+    NotifyThread(notifier, None).retry_one(reqmock, timeout=0)
     url, data, timeout = reqmock.requests[0]
     assert data == "01234"
     url, data, timeout = reqmock.requests[1]
     assert data == "45678"
     assert metadata.get_tokens_for_addr(testaddr) == ["45678"]
-    assert notifier.retry_queues[0].qsize() == 0
-    assert notifier.retry_queues[1].qsize() == 0
+    assert notifier.scheduler.qsize() == 0
 
 
 def test_persistent_queue_items(tmp_path, testaddr, token):
-    queue_item = PersistentQueueItem.create(tmp_path, testaddr, 432, token)
+    queue_item = QueueJournal(tmp_path).enqueue(testaddr, 432, token)
     assert queue_item.addr == testaddr
     assert queue_item.start_ts == 432
     assert queue_item.token == token
-    item2 = PersistentQueueItem.read_from_path(queue_item.path)
+    journal2 = QueueJournal(tmp_path)
+    [item2] = journal2.replay()
     assert item2.addr == testaddr
     assert item2.start_ts == 432
     assert item2.token == token
     assert item2 == queue_item
     item2.delete()
-    assert not item2.path.exists()
+    assert journal2.qsize() == 0
+    assert QueueJournal(tmp_path).replay() == []
     assert not queue_item < item2 and not item2 < queue_item
 
 
+def test_queue_journal_compaction(tmp_path, testaddr):
+    journal = QueueJournal(tmp_path)
+    journal.COMPACT_RECORDS = 10
+    queue_items = [journal.enqueue(testaddr, 432, f"token{i}") for i in range(20)]
+    for queue_item in queue_items[:-2]:
+        queue_item.delete()
+    # acknowledged records were dropped with the older segments
+    assert len(journal.get_segment_seqs()) == 1
+    assert len(journal.get_segment_path(journal.seq).read_bytes().splitlines()) < 10
+    replayed = QueueJournal(tmp_path).replay()
+    assert sorted(item.token for item in replayed) == ["token18", "token19"]
+
+
+def test_queue_journal_interrupted_writes(tmp_path, testaddr, caplog):
+    journal = QueueJournal(tmp_path)
+    queue_item = journal.enqueue(testaddr, 432, "01234")
+    journal.enqueue(testaddr, 432, "56789").delete()
+    # a compaction that crashed before removing the older segment
+    journal._open_segment()
+    journal._append(queue_item.record())
+    # a record that was cut short by a crash
+    os.write(journal.fd, b'{"id": "1234", "ad')
+    journal.close()
+    assert len(journal.get_segment_seqs()) == 2
+
+    journal2 = QueueJournal(tmp_path)
+    assert journal2.replay() == [queue_item]
+    assert "corrupt" in caplog.records[0].msg
+    assert len(journal2.get_segment_seqs()) == 1
+
+
+def test_requeue_migrates_queue_files(notifier, testaddr):
+    start_ts = int(time.time())
+    path = write_queue_file(notifier.queue_dir, testaddr, start_ts, "01234")
+    notifier.requeue_persistent_queue_items()
+    assert not path.exists()
+    assert notifier.scheduler.qsize() == 1
+    [queue_item] = QueueJournal(notifier.queue_dir).replay()
+    assert (queue_item.addr, queue_item.start_ts) == (testaddr, start_ts)
+    assert queue_item.token == "01234"
+
+
 def test_turn_credentials_exception_returns_N(notifier, metadata, monkeypatch):
     """Test that turn_credentials() failure returns N\\n instead of crashing."""
     import chatmaild.metadata
@@ -402,10 +466,188 @@ def test_legacy_token_migration(metadata, testaddr):
         data[metadata.DEVICETOKEN_KEY] = ["oldtoken1", "oldtoken2"]
 
     assert metadata.get_tokens_for_addr(testaddr) == ["oldtoken1", "oldtoken2"]
+    # reading does not write, the next token change converts the format
+    mdict = metadata.get_metadata_dict(testaddr).read()
+    assert isinstance(mdict[metadata.DEVICETOKEN_KEY], list)
+
+    metadata.add_token_to_addr(testaddr, "newtoken")
     mdict = metadata.get_metadata_dict(testaddr).read()
     tokens = mdict[metadata.DEVICETOKEN_KEY]
     assert isinstance(tokens, dict)
-    assert "oldtoken1" in tokens and "oldtoken2" in tokens
+    assert list(tokens) == ["oldtoken1", "oldtoken2", "newtoken"]
+
+
+def test_tokens_are_read_from_memory(metadata, testaddr, monkeypatch):
+    metadata.add_token_to_addr(testaddr, "01234")
+
+    def fail_read(self):
+        raise AssertionError("metadata file read")
+
+    monkeypatch.setattr(FileDict, "read", fail_read)
+    for _ in range(3):
+        assert metadata.get_tokens_for_addr(testaddr) == ["01234"]
+
+
+def test_token_index_notices_other_writers(tmp_path, testaddr):
+    metadata1 = Metadata(tmp_path)
+    metadata2 = Metadata(tmp_path)
+    metadata1.add_token_to_addr(testaddr, "01234")
+    assert metadata2.get_tokens_for_addr(testaddr) == ["01234"]
+    metadata1.add_token_to_addr(testaddr, "56789")
+    assert metadata2.get_tokens_for_addr(testaddr) == ["01234", "56789"]
+
+    shutil.rmtree(tmp_path.joinpath(testaddr))
+    assert metadata2.get_tokens_for_addr(testaddr) == []
+
+
+def test_token_index_is_bounded(metadata, monkeypatch):
+    monkeypatch.setattr(metadata, "CACHE_SIZE", 3)
+    for i in range(5):
+        metadata.add_token_to_addr(f"user{i}@example.org", f"token{i}")
+    assert list(metadata.token_index) == [f"user{i}@example.org" for i in range(2, 5)]
+    assert metadata.get_tokens_for_addr("user0@example.org") == ["token0"]
+
+
+def test_token_writes_locked_per_address(metadata, testaddr):
+    other = next(
+        addr
+        for addr in (f"user{i}@example.org" for i in range(100))
+        if metadata._write_lock(addr) is not metadata._write_lock(testaddr)
+    )
+    with metadata._write_lock(testaddr):
+        thread = threading.Thread(target=metadata.add_token_to_addr, args=(other, "t"))
+        thread.start()
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+    assert metadata.get_tokens_for_addr(other) == ["t"]
+
+
+def test_token_write_merges_concurrent_write(metadata, testaddr, monkeypatch):
+    metadata.add_token_to_addr(testaddr, "t1")
+    mdict = metadata.get_metadata_dict(testaddr)
+    parse = mdict._parse
+    parsed = []
+    monkeypatch.setattr(mdict, "_parse", lambda raw: parsed.append(raw) or parse(raw))
+    with metadata._modify_tokens(testaddr) as tokens:
+        # the file of the last write is not parsed again
+        assert not parsed
+        tokens["t2"] = int(time.time())
+        # e.g. chatmail-expire writing the file in between
+        with FileDict(mdict.path).modify() as data:
+            data[metadata.DEVICETOKEN_KEY]["t3"] = int(time.time())
+    assert metadata.get_tokens_for_addr(testaddr) == ["t1", "t3", "t2"]
+    assert FileDict(mdict.path).read() == mdict.read()
+
+
+def test_expire_tokens(metadata, testaddr, monkeypatch):
+    now = int(time.time())
+    expired = now - 3600 * 24 * 91
+    with metadata.get_metadata_dict(testaddr).modify() as data:
+        data[metadata.DEVICETOKEN_KEY] = {"old": expired, "new": now}
+
+    def fail_write(*args):
+        raise AssertionError("metadata file written")
+
+    with monkeypatch.context() as m:
+        m.setattr(FileDict, "compare_and_swap", fail_write)
+        assert metadata.get_tokens_for_addr(testaddr) == ["new"]
+        assert metadata.expire_tokens(testaddr, now, dry=True) == 1
+
+    assert metadata.expire_tokens(testaddr, now) == 1
+    data = metadata.get_metadata_dict(testaddr).read()
+    assert list(data[metadata.DEVICETOKEN_KEY]) == ["new"]
+    assert metadata.get_tokens_for_addr(testaddr) == ["new"]
+    assert metadata.expire_tokens(testaddr, now) == 0
+
+
+def test_sqlite_metadata_persistence(tmp_path, testaddr, testaddr2):
+    metadata1 = SqliteMetadata(tmp_path)
+    metadata2 = SqliteMetadata(tmp_path)
+    assert not metadata2.get_tokens_for_addr(testaddr)
+
+    metadata1.add_token_to_addr(testaddr, "01234")
+    metadata1.add_token_to_addr(testaddr, "56789")
+    metadata1.add_token_to_addr(testaddr2, "456")
+    assert metadata2.get_tokens_for_addr(testaddr) == ["01234", "56789"]
+    metadata2.remove_token_from_addr(testaddr, "01234")
+    assert metadata1.get_tokens_for_addr(testaddr) == ["56789"]
+    assert metadata1.get_tokens_for_addr(testaddr2) == ["456"]
+    assert not tmp_path.joinpath(testaddr).exists()
+    metadata1.close()
+    metadata2.close()
+
+
+def test_sqlite_metadata_expire_all_tokens(tmp_path, testaddr, testaddr2):
+    metadata = SqliteMetadata(tmp_path)
+    expired = int(time.time()) - 3600 * 24 * 91
+    metadata.import_tokens(
+        [(testaddr, "old", expired), (testaddr2, "old", expired)]
+        + [(testaddr, "new", int(time.time()))]
+    )
+    tmp_path.joinpath(testaddr).mkdir()
+    tmp_path.joinpath(testaddr2).mkdir()
+    tmp_path.joinpath("removed@example.org").mkdir()
+    metadata.import_tokens([("removed@example.org", "token", int(time.time()))])
+    # the mailbox directory was removed without chatmail-expire
+    metadata.import_tokens([("gone@example.org", "token", int(time.time()))])
+    assert metadata.get_tokens_for_addr(testaddr) == ["new"]
+    assert metadata.get_tokens_for_addr(testaddr2) == []
+
+    now = int(time.time())
+    removed = ["removed@example.org"]
+    assert metadata.expire_all_tokens(now, removed, dry=True) == (4, 4)
+    assert metadata.expire_all_tokens(now, removed) == (4, 4)
+    rows = metadata.conn.execute("SELECT addr, token FROM tokens").fetchall()
+    assert rows == [(testaddr, "new")]
+    assert metadata.expire_all_tokens(now) == (0, 0)
+
+
+def test_sqlite_metadata_expire_tokens(tmp_path, testaddr):
+    metadata = SqliteMetadata(tmp_path)
+    now = int(time.time())
+    metadata.import_tokens([(testaddr, "old", now - 3600 * 24 * 91)])
+    metadata.import_tokens([(testaddr, "new", now)])
+    assert metadata.expire_tokens(testaddr, now, dry=True) == 1
+    assert metadata.expire_tokens(testaddr, now) == 1
+    rows = metadata.conn.execute("SELECT token FROM tokens").fetchall()
+    assert rows == [("new",)]
+
+
+def test_sqlite_token_index_read_races_write(tmp_path, testaddr, monkeypatch):
+    metadata = SqliteMetadata(tmp_path)
+    metadata.add_token_to_addr(testaddr, "t1")
+    metadata.token_index.clear()
+    read_tokens = metadata._read_tokens
+
+    def read_then_write(addr):
+        tokens = read_tokens(addr)
+        # a write on the same connection between reading and storing
+        monkeypatch.setattr(metadata, "_read_tokens", read_tokens)
+        metadata.add_token_to_addr(addr, "t2")
+        return tokens
+
+    monkeypatch.setattr(metadata, "_read_tokens", read_then_write)
+    assert metadata.get_tokens_for_addr(testaddr) == ["t1"]
+    assert metadata.get_tokens_for_addr(testaddr) == ["t1", "t2"]
+
+    metadata.import_tokens([(testaddr, "t3", int(time.time()))])
+    assert metadata.get_tokens_for_addr(testaddr) == ["t1", "t2", "t3"]
+
+
+def test_sqlite_metadata_notifier(tmp_path, testaddr):
+    metadata = SqliteMetadata(tmp_path)
+    queue_dir = tmp_path.joinpath("pending_notifications")
+    queue_dir.mkdir()
+    notifier = Notifier(queue_dir)
+    metadata.add_token_to_addr(testaddr, "01234")
+    metadata.add_token_to_addr(testaddr, "45678")
+    notifier.new_message_for_addr(testaddr, metadata)
+
+    reqmock = get_mocked_requests([410, 200])
+    thread = NotifyThread(notifier, metadata.remove_token_from_addr)
+    thread.retry_one(reqmock, timeout=0)
+    NotifyThread(notifier, None).retry_one(reqmock, timeout=0)
+    assert metadata.get_tokens_for_addr(testaddr) == ["45678"]
 
 
 @pytest.mark.parametrize(
@@ -426,3 +668,403 @@ def test_shared_lookup(dictproxy, suffix, expected):
     rfile, wfile = io.BytesIO(b"H\n" + key), io.BytesIO()
     dictproxy.loop_forever(rfile, wfile)
     assert wfile.getvalue() == expected
+
+
+def test_notifier_coalesces_burst(metadata, notifier, testaddr, testaddr2):
+    metadata.add_token_to_addr(testaddr, "01234")
+    metadata.add_token_to_addr(testaddr, "56789")
+    metadata.add_token_to_addr(testaddr2, "01234")
+    for _ in range(20):
+        notifier.new_message_for_addr(testaddr, metadata)
+        notifier.new_message_for_addr(testaddr2, metadata)
+
+    assert notifier.scheduler.qsize() == 3
+    assert notifier.journal.qsize() == 3
+    assert notifier.coalesced == 57
+
+    reqmock = get_mocked_requests([200, 200, 200])
+    for _ in range(3):
+        assert NotifyThread(notifier, None).retry_one(reqmock, timeout=0)
+    assert sorted(data for url, data, timeout in reqmock.requests) == [
+        "01234",
+        "01234",
+        "56789",
+    ]
+    assert notifier.journal.qsize() == 0
+
+
+def test_notifier_enqueue_failure(metadata, notifier, testaddr, monkeypatch):
+    metadata.add_token_to_addr(testaddr, "01234")
+
+    def fail_enqueue(*args):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as m:
+        m.setattr(notifier.journal, "enqueue", fail_enqueue)
+        with pytest.raises(OSError):
+            notifier.new_message_for_addr(testaddr, metadata)
+    assert not notifier.pending
+
+    notifier.new_message_for_addr(testaddr, metadata)
+    assert notifier.scheduler.qsize() == 1
+    assert notifier.journal.qsize() == 1
+    assert notifier.coalesced == 0
+
+
+def test_notifier_burst_during_attempt(metadata, notifier, testaddr):
+    metadata.add_token_to_addr(testaddr, "01234")
+    notifier.new_message_for_addr(testaddr, metadata)
+    when, (retry_num, queue_item) = notifier.scheduler.get(timeout=0)
+    assert when <= time.time()
+
+    # messages arriving once the notification is being sent
+    # are notified again after the coalescing window
+    notifier.start_attempt(queue_item)
+    for _ in range(10):
+        notifier.new_message_for_addr(testaddr, metadata)
+    assert notifier.scheduler.qsize() == 1
+    when = notifier.scheduler.next_due()
+    retry_num, queue_item2 = notifier.scheduler.entries()[0]
+    assert queue_item2 != queue_item
+    assert when >= time.time() + notifier.COALESCE_WINDOW - 1
+
+    reqmock = get_mocked_requests([200])
+    thread = NotifyThread(notifier, None)
+    assert not thread.retry_one(reqmock, timeout=0)
+    notifier.scheduler.clock = lambda: when
+    assert thread.retry_one(reqmock, timeout=0)
+    assert reqmock.requests
+
+
+def test_requeue_drops_expired_items_unread(notifier, testaddr, caplog):
+    path = write_queue_file(notifier.queue_dir, testaddr, time.time(), "01234")
+    segment = notifier.queue_dir.joinpath(f"00000001{QueueJournal.SEGMENT_SUFFIX}")
+    # invalid contents would be noticed if the files were read
+    segment.write_text("invalid")
+    path.write_text("invalid")
+    expired = time.time() - notifier.DROP_DEADLINE - 60
+    os.utime(path, (expired, expired))
+    os.utime(segment, (expired, expired))
+    notifier2 = notifier.__class__(notifier.queue_dir)
+    notifier2.requeue_persistent_queue_items()
+    assert not path.exists() and not segment.exists()
+    assert notifier2.scheduler.qsize() == 0
+    assert not any("spurious" in r.msg or "corrupt" in r.msg for r in caplog.records)
+    assert "exceeding deadline" in caplog.text
+
+
+def test_recovery_runs_in_background(notifier, metadata, testaddr, monkeypatch):
+    metadata.add_token_to_addr(testaddr, "01234")
+    write_queue_file(notifier.queue_dir, testaddr, time.time(), "56789")
+    replaying = threading.Event()
+    release = threading.Event()
+    replay = notifier.journal.replay
+
+    def blocking_replay(*args):
+        replaying.set()
+        release.wait(timeout=10)
+        return replay(*args)
+
+    monkeypatch.setattr(notifier.journal, "replay", blocking_replay)
+    notifier.new_session = lambda: get_mocked_requests([200] * 10)
+    notifier.start_notification_threads(None)
+    assert replaying.wait(timeout=10)
+    # new messages are queued while the recovery is still running
+    notifier.new_message_for_addr(testaddr, metadata)
+    release.set()
+    notifier.recovery_thread.join(timeout=10)
+    for _ in range(500):
+        if not notifier.journal.qsize():
+            break
+        time.sleep(0.01)
+    assert notifier.journal.qsize() == 0
+    suffix = QueueJournal.SEGMENT_SUFFIX
+    assert all(p.name.endswith(suffix) for p in notifier.queue_dir.iterdir())
+    notifier.stop_notification_threads()
+
+
+def test_requeue_coalesces_duplicates(notifier, metadata, testaddr):
+    metadata.add_token_to_addr(testaddr, "01234")
+    for _ in range(3):
+        write_queue_file(notifier.queue_dir, testaddr, time.time(), "01234")
+    notifier.requeue_persistent_queue_items()
+    assert notifier.scheduler.qsize() == 1
+    assert notifier.journal.qsize() == 1
+    notifier.new_message_for_addr(testaddr, metadata)
+    assert notifier.scheduler.qsize() == 1
+
+
+def test_scheduler_releases_in_due_order():
+    now = 1000
+    scheduler = Scheduler(clock=lambda: now)
+    scheduler.put(now + 10, "later")
+    scheduler.put(now, "first")
+    scheduler.put(now, "second")
+    assert scheduler.get(timeout=0) == (now, "first")
+    assert scheduler.get(timeout=0) == (now, "second")
+    assert scheduler.get(timeout=0) is None
+    assert scheduler.qsize() == 1
+    now += 10
+    assert scheduler.get(timeout=0) == (now, "later")
+
+
+def test_scheduler_wakes_on_earlier_entry():
+    scheduler = Scheduler()
+    scheduler.put(time.time() + 3600, "later")
+    results = []
+    thread = threading.Thread(target=lambda: results.append(scheduler.get()))
+    thread.start()
+    scheduler.put(time.time(), "now")
+    thread.join(timeout=5)
+    assert results[0][1] == "now"
+    scheduler.close()
+    assert scheduler.get() is None
+
+
+def test_scheduler_stats():
+    now = 1000
+    scheduler = Scheduler(clock=lambda: now)
+    assert scheduler.get_stats() == (0, 0, 0)
+    scheduler.put(now - 5, "late")
+    scheduler.put(now, "due")
+    scheduler.put(now + 5, "later")
+    assert scheduler.get_stats() == (3, 2, 5)
+    assert scheduler.needs_worker()
+
+
+def test_notifier_stats(notifier, metadata, testaddr, caplog):
+    metadata.add_token_to_addr(testaddr, "01234")
+    notifier.new_message_for_addr(testaddr, metadata)
+    notifier.new_message_for_addr(testaddr, metadata)
+    stats = notifier.get_stats()
+    assert stats["queued"] == stats["due"] == 1
+    assert stats["coalesced"] == 1
+    assert stats["workers"] == 0
+    caplog.set_level(logging.INFO)
+    notifier.log_stats()
+    assert "queued=1" in caplog.records[0].msg
+
+
+def test_notifier_pool_grows_and_shrinks(notifier, metadata, testaddr):
+    notifier.WORKER_IDLE_TIMEOUT = 0.05
+    release = threading.Event()
+
+    class BlockingSession:
+        def post(self, url, data, timeout):
+            release.wait(timeout=10)
+            return get_mocked_requests([200]).post(url, data, timeout)
+
+    notifier.new_session = BlockingSession
+    threads = notifier.start_notification_threads(None)
+    assert len(threads) == notifier.MIN_WORKERS
+    for i in range(notifier.MIN_WORKERS * 2):
+        metadata.add_token_to_addr(testaddr, f"token{i}")
+    notifier.new_message_for_addr(testaddr, metadata)
+    for _ in range(500):
+        if len(notifier.workers) == notifier.MIN_WORKERS * 2:
+            break
+        time.sleep(0.01)
+    assert len(notifier.workers) == notifier.MIN_WORKERS * 2
+
+    release.set()
+    for _ in range(500):
+        if len(notifier.workers) == notifier.MIN_WORKERS:
+            break
+        time.sleep(0.01)
+    assert len(notifier.workers) == notifier.MIN_WORKERS
+    assert notifier.journal.qsize() == 0
+    notifier.stop_notification_threads()
+
+
+def test_circuit_breaker_adapts_limit():
+    breaker = CircuitBreaker(8)
+    assert breaker.acquire()
+    breaker.release(success=False)
+    assert breaker.limit == 4
+    for _ in range(4):
+        assert breaker.acquire()
+    assert not breaker.acquire()
+    assert breaker.get_delay() == breaker.LIMITED_DELAY
+    for _ in range(4):
+        breaker.release(success=True)
+    assert 4.5 < breaker.limit < 5
+    assert breaker.has_capacity()
+
+
+def test_circuit_breaker_opens_and_probes():
+    now = 1000
+    breaker = CircuitBreaker(8, clock=lambda: now)
+    for _ in range(breaker.FAILURE_THRESHOLD):
+        assert breaker.acquire()
+        breaker.release(success=False)
+    assert breaker.is_open() and not breaker.has_capacity()
+    assert not breaker.acquire()
+    assert breaker.get_delay() == breaker.OPEN_TIMEOUT
+
+    # a failing probe opens the circuit again
+    now += breaker.OPEN_TIMEOUT
+    assert breaker.acquire()
+    assert not breaker.acquire()
+    breaker.release(success=False)
+    assert not breaker.acquire()
+
+    # a successful probe closes it
+    now += breaker.OPEN_TIMEOUT
+    assert breaker.acquire()
+    breaker.release(success=True)
+    assert not breaker.is_open()
+    assert breaker.acquire() and breaker.acquire()
+
+
+def test_notifier_parks_items_while_circuit_open(notifier, metadata, testaddr):
+    now = time.time()
+    notifier.scheduler.clock = notifier.breaker.clock = lambda: now
+    for _ in range(notifier.breaker.FAILURE_THRESHOLD):
+        notifier.breaker.acquire()
+        notifier.breaker.release(success=False)
+    assert notifier.get_stats()["circuit_open"]
+
+    metadata.add_token_to_addr(testaddr, "01234")
+    notifier.new_message_for_addr(testaddr, metadata)
+    reqmock = get_mocked_requests([200])
+    thread = NotifyThread(notifier, None)
+    assert thread.retry_one(reqmock, timeout=0)
+    assert not reqmock.requests
+    [(retry_num, queue_item)] = notifier.scheduler.entries()
+    assert retry_num == 0
+    assert notifier.scheduler.next_due() == int(now) + notifier.breaker.OPEN_TIMEOUT
+
+    # the parked item is the probe that closes the circuit again
+    now += notifier.breaker.OPEN_TIMEOUT
+    assert thread.retry_one(reqmock, timeout=0)
+    assert reqmock.requests
+    assert not notifier.breaker.is_open()
+    assert notifier.journal.qsize() == 0
+
+
+class H2StandInServer:
+    """Cleartext HTTP/2 server answering POSTs like the notification service."""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.tokens = []
+        self.connections = 0
+        self.open_streams = 0
+        self.max_open_streams = 0
+
+    async def handle(self, reader, writer):
+        import h2.config
+        import h2.connection
+        import h2.events
+
+        self.connections += 1
+        config = h2.config.H2Configuration(client_side=False)
+        conn = h2.connection.H2Connection(config=config)
+        conn.initiate_connection()
+        writer.write(conn.data_to_send())
+        bodies = {}
+        while data := await reader.read(65536):
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    bodies[event.stream_id] = b""
+                elif isinstance(event, h2.events.DataReceived):
+                    bodies[event.stream_id] += event.data
+                    conn.acknowledge_received_data(
+                        event.flow_controlled_length, event.stream_id
+                    )
+                elif isinstance(event, h2.events.StreamEnded):
+                    body = bodies.pop(event.stream_id)
+                    asyncio.create_task(
+                        self.respond(conn, writer, event.stream_id, body)
+                    )
+            writer.write(conn.data_to_send())
+            await writer.drain()
+
+    async def respond(self, conn, writer, stream_id, body):
+        self.open_streams += 1
+        self.max_open_streams = max(self.max_open_streams, self.open_streams)
+        await asyncio.sleep(self.delay)
+        self.open_streams -= 1
+        token = body.decode()
+        self.tokens.append(token)
+        status = "410" if token.startswith("gone") else "200"
+        headers = [(":status", status), ("content-length", "0")]
+        conn.send_headers(stream_id, headers, end_stream=True)
+        writer.write(conn.data_to_send())
+
+
+@pytest.fixture
+def h2server():
+    pytest.importorskip("h2")
+    pytest.importorskip("httpx")
+    server = H2StandInServer()
+    loop = asyncio.new_event_loop()
+    tcp_server = loop.run_until_complete(
+        asyncio.start_server(server.handle, "127.0.0.1", 0)
+    )
+    port = tcp_server.sockets[0].getsockname()[1]
+    server.url = f"http://127.0.0.1:{port}/notify"
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield server
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+@pytest.fixture
+def http2_session(h2server):
+    # the stand-in server speaks HTTP/2 without TLS and ALPN negotiation
+    session = HTTP2Session(max_streams=8, http1=False)
+    yield session
+    session.close()
+
+
+def test_http2_session_multiplexes_requests(h2server, http2_session):
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        results = list(
+            executor.map(
+                lambda i: http2_session.post(h2server.url, data=f"token{i}", timeout=5),
+                range(40),
+            )
+        )
+    assert [res.status_code for res in results] == [200] * 40
+    assert sorted(h2server.tokens) == sorted(f"token{i}" for i in range(40))
+    assert h2server.connections == 1
+    assert 1 < h2server.max_open_streams <= 8
+
+
+def test_http2_session_connection_error(http2_session):
+    with pytest.raises(requests.exceptions.RequestException):
+        http2_session.post("http://127.0.0.1:1/notify", data="token", timeout=5)
+
+
+def test_notifier_over_http2(metadata, notifier, testaddr, h2server, http2_session):
+    notifier.URL = h2server.url
+    notifier.http2_session = http2_session
+    metadata.add_token_to_addr(testaddr, "gone1")
+    metadata.add_token_to_addr(testaddr, "01234")
+    notifier.new_message_for_addr(testaddr, metadata)
+
+    session = notifier.new_session()
+    assert session is http2_session
+    thread = NotifyThread(notifier, metadata.remove_token_from_addr)
+    for _ in range(2):
+        assert thread.retry_one(session, timeout=0)
+    assert sorted(h2server.tokens) == ["01234", "gone1"]
+    assert metadata.get_tokens_for_addr(testaddr) == ["01234"]
+    assert notifier.journal.qsize() == 0
+
+
+def test_notifier_http2_fallback(notifier, monkeypatch):
+    import chatmaild.notifier
+
+    def missing_httpx(max_streams):
+        raise ImportError("No module named 'httpx'")
+
+    monkeypatch.setattr(chatmaild.notifier, "HTTP2Session", missing_httpx)
+    notifier.http2_streams = 10
+    threads = notifier.start_notification_threads(None)
+    assert len(threads) == notifier.MIN_WORKERS
+    assert notifier.max_workers == notifier.MAX_WORKERS
+    assert isinstance(notifier.new_session(), requests.Session)
+    notifier.stop_notification_threads()
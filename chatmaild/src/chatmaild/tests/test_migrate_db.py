@@ -1,6 +1,8 @@
 import sqlite3
+import time
 
-from chatmaild.migrate_db import migrate_from_db_to_maildir
+from chatmaild.metadata import Metadata, SqliteMetadata
+from chatmaild.migrate_db import migrate_from_db_to_maildir, migrate_metadata_to_sqlite
 
 
 def test_migration_not_exists(tmp_path, example_config):
@@ -67,3 +69,35 @@ def test_migration(tmp_path, example_config, caplog):
 
     assert not all
     assert not example_config.passdb_path.exists()
+
+
+def test_metadata_migration(tmp_path, caplog):
+    caplog.set_level("INFO")
+    metadata = Metadata(tmp_path)
+    for i in range(25):
+        metadata.add_token_to_addr(f"user{i:02}@example.org", f"token{i}")
+    metadata.add_token_to_addr("user00@example.org", "second")
+    with metadata.get_metadata_dict("legacy@example.org").modify() as data:
+        data[metadata.DEVICETOKEN_KEY] = ["oldtoken"]
+    tmp_path.joinpath("empty@example.org").mkdir()
+
+    sqlite_metadata = SqliteMetadata(tmp_path)
+    migrate_metadata_to_sqlite(sqlite_metadata, chunking=10)
+    assert "all device tokens migrated" in caplog.messages[-1]
+
+    assert not list(tmp_path.glob("*/metadata.json*"))
+    assert sqlite_metadata.get_tokens_for_addr("user00@example.org") == [
+        "token0",
+        "second",
+    ]
+    for i in range(1, 25):
+        addr = f"user{i:02}@example.org"
+        assert sqlite_metadata.get_tokens_for_addr(addr) == [f"token{i}"]
+    assert sqlite_metadata.get_tokens_for_addr("legacy@example.org") == ["oldtoken"]
+
+    # running the migration again is a no-op
+    caplog.clear()
+    migrate_metadata_to_sqlite(sqlite_metadata)
+    assert not caplog.records
+    timestamp = sqlite_metadata.conn.execute("SELECT min(timestamp) FROM tokens")
+    assert timestamp.fetchone()[0] <= time.time()
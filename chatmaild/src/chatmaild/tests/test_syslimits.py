@@ -2,7 +2,13 @@ import shutil
 
 import psutil
 
-from chatmaild.syslimits import has_sufficient_resources
+from chatmaild.fsreport import main as report_main
+from chatmaild.syslimits import (
+    ResourceSampler,
+    get_sampler,
+    get_textfile_lines,
+    has_sufficient_resources,
+)
 
 PERMISSIVE = {
     "max_load_1m": "99999",
@@ -43,3 +49,42 @@ def test_one_unreadable_value_keeps_other_checks(make_config, monkeypatch, caplo
     )
     assert not has_sufficient_resources(config)
     assert "ignoring" in caplog.text
+
+
+def test_sampler_reuses_readings(tmp_path, monkeypatch):
+    calls = []
+    orig = psutil.getloadavg
+    monkeypatch.setattr(psutil, "getloadavg", lambda: calls.append(1) or orig())
+    sampler = ResourceSampler(str(tmp_path), interval=60)
+    readings = sampler.get_readings()
+    assert readings.mem > 0 and readings.disk > 0
+    assert sampler.get_readings() is readings
+    assert len(calls) == 1
+
+    sampler.expires = 0
+    assert sampler.get_readings() is not readings
+    assert len(calls) == 2
+
+
+def test_sampler_shared_per_config(make_config):
+    config = make_config("chat.example.org", PERMISSIVE)
+    assert get_sampler(config) is get_sampler(config)
+    config2 = make_config(
+        "chat.example.org", PERMISSIVE | {"resource_sample_interval": "0"}
+    )
+    assert config2.resource_sample_interval == 0
+    assert get_sampler(config2) is not get_sampler(config)
+
+
+def test_textfile_lines(make_config, tmp_path):
+    config = make_config("chat.example.org", PERMISSIVE)
+    lines = get_textfile_lines(config)
+    assert any(line.startswith('chatmail_system_bytes{kind="disk"} ') for line in lines)
+    assert not any(line.startswith("chatmail_system_load1") for line in lines)
+    assert 'chatmail_system_limit{kind="load1"} 99999.0' in lines
+
+    textfile = tmp_path.joinpath("fsreport.prom")
+    report_main([str(config._inipath), "--textfile", str(textfile)])
+    content = textfile.read_text()
+    assert "chatmail_storage_bytes" in content
+    assert 'chatmail_system_bytes{kind="disk"}' in content